@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Офлайн-бенчмарк хэндлеров без живого Telegram.
+
+Строит синтетические апдейты (Message/CallbackQuery), прогоняет их через
+настоящие хэндлеры bot.py на засеянной SQLite-базе, а исходящие вызовы
+Bot API перехватывает заглушкой (apihelper.CUSTOM_REQUEST_SENDER) — сеть
+не используется. По каждому сценарию печатает пропускную способность,
+p50/p99 задержки, число SQL-выражений и вызовов API на апдейт.
+
+Запуск:
+  python bench.py --users 10000 --updates 2000
+  python bench.py --users 1000000 --db /tmp/bench_1m.db   # засеянная база переиспользуется
+  python bench.py --save-baseline bench_baseline.json
+  python bench.py --compare bench_baseline.json           # код 1 при регрессии
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+from telebot import apihelper, types
+
+import bot
+
+HABITS_PER_USER = 2
+USERS_PER_CHALLENGE = 100
+PARTICIPANTS_PER_CHALLENGE = 20
+
+_ids = itertools.count(1)
+
+
+# ===================== ЗАГЛУШКА BOT API =====================
+
+class _Response:
+    status_code = 200
+    reason = "OK"
+
+    def __init__(self, payload):
+        self._payload = payload
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return self._payload
+
+
+class RecordingApi:
+    """Отвечает как Bot API и только считает вызовы по методам."""
+
+    def __init__(self):
+        self.calls = Counter()
+
+    def __call__(self, method, url, params=None, **kwargs):
+        name = url.rsplit("/", 1)[-1]
+        self.calls[name] += 1
+        params = params or {}
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "KarmaBot", "username": "karma_bot"}
+        elif name in ("sendMessage", "editMessageText"):
+            result = {"message_id": next(_ids), "date": 0, "text": params.get("text", ""),
+                      "chat": {"id": int(params.get("chat_id", 0)), "type": "private"}}
+        else:
+            result = True
+        return _Response({"ok": True, "result": result})
+
+
+# ===================== ДАННЫЕ =====================
+
+def seed(users):
+    """Пользователи, по HABITS_PER_USER привычек, челленджи с участниками, журнал кармы."""
+    now = datetime.now().isoformat()
+    rng = random.Random(42)
+    challenges = max(1, users // USERS_PER_CHALLENGE)
+    chunk = 50000
+    with bot.transaction() as c:
+        for start in range(1, users + 1, chunk):
+            ids = range(start, min(users, start + chunk - 1) + 1)
+            c.executemany("INSERT INTO users (user_id, username, karma, level, created_date) VALUES (?, ?, ?, ?, ?)",
+                          [(uid, f"user{uid}", rng.randrange(100), rng.randrange(1, 30), now) for uid in ids])
+            c.executemany("INSERT INTO habits (user_id, name, target, current_progress, created_date) "
+                          "VALUES (?, ?, 1000000, 0, ?)",
+                          [(uid, f"habit{k}", now) for uid in ids for k in range(HABITS_PER_USER)])
+            c.executemany("INSERT INTO karma_events (user_id, amount, credited, reason, created_at) "
+                          "VALUES (?, 10, 10, 'seed', ?)", [(uid, now) for uid in ids])
+        # цели недостижимы — прогресс не завершает челленджи посреди замера
+        c.executemany("INSERT INTO challenges (name, description, creator_id, prize_pool, is_public, created_at, "
+                      "status, target_count) VALUES (?, 'bench', ?, 100, 1, ?, 'active', 1000000)",
+                      [(f"challenge{i}", rng.randrange(1, users + 1), now) for i in range(challenges)])
+        for chl_id in range(1, challenges + 1):
+            members = {rng.randrange(1, users + 1) for _ in range(PARTICIPANTS_PER_CHALLENGE)}
+            c.executemany("INSERT OR IGNORE INTO challenge_participants (challenge_id, user_id, progress, joined_at) "
+                          "VALUES (?, ?, 0, ?)", [(chl_id, uid, now) for uid in members])
+
+
+def prepare_db(path, users):
+    fresh = not os.path.exists(path)
+    bot.DB_PATH = path
+    bot.init_db()
+    if fresh:
+        started = time.perf_counter()
+        seed(users)
+        print(f"База {path}: засеяно {users} пользователей за {time.perf_counter() - started:.1f} с")
+    else:
+        users = bot.fetch_one("SELECT COUNT(*) FROM users")[0]
+        print(f"База {path}: переиспользуется, пользователей {users}")
+    return users
+
+
+# ===================== АПДЕЙТЫ =====================
+
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"user{uid}", "username": f"user{uid}"}
+
+
+def message_update(uid, text):
+    msg = {"message_id": next(_ids), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+           "from": _user(uid), "text": text}
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return types.Update.de_json({"update_id": next(_ids), "message": msg})
+
+
+def callback_update(uid, data):
+    return types.Update.de_json({"update_id": next(_ids), "callback_query": {
+        "id": str(next(_ids)), "chat_instance": str(uid), "data": data, "from": _user(uid),
+        "message": {"message_id": next(_ids), "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"}, "text": "menu"}}})
+
+
+def make_scenarios(users, rng):
+    """name → функция, возвращающая очередной апдейт."""
+    challenges = bot.fetch_one("SELECT COUNT(*) FROM challenges")[0]
+    members = bot.fetch_all("SELECT challenge_id, user_id FROM challenge_participants")
+    user = lambda: rng.randrange(1, users + 1)
+
+    def habit_progress():
+        uid = user()
+        habit_id = (uid - 1) * HABITS_PER_USER + rng.randrange(HABITS_PER_USER) + 1
+        return callback_update(uid, f"habit:progress:{habit_id}")
+
+    def chl_progress():
+        chl_id, uid = rng.choice(members)
+        return callback_update(uid, f"chl:prog_inc:{chl_id}")
+
+    return {
+        "habit_progress": habit_progress,
+        "chl_progress": chl_progress,
+        "chl_details": lambda: callback_update(user(), f"chl:details:{rng.randrange(1, challenges + 1)}"),
+        "chl_public": lambda: callback_update(user(), "chl:public"),
+        "my_challenges": lambda: message_update(rng.choice(members)[1], "🧩 Мои челленджи"),
+        "my_habits": lambda: message_update(user(), "🎯 Мои привычки"),
+        "leaderboard": lambda: message_update(user(), "🏅 Лидеры"),
+        "stats": lambda: message_update(user(), "📊 Статистика"),
+        "daily_reward": lambda: message_update(user(), "🎁 Ежедневная награда"),
+    }
+
+
+# ===================== ЗАМЕР =====================
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_scenario(make_update, updates, warmup, api):
+    for _ in range(warmup):
+        bot.bot.process_new_updates([make_update()])
+    batch = [make_update() for _ in range(updates)]
+
+    statements = []
+    conn = bot.db()
+    conn.set_trace_callback(statements.append)
+    api.calls.clear()
+    latencies = []
+    started = time.perf_counter()
+    for update in batch:
+        t0 = time.perf_counter()
+        bot.bot.process_new_updates([update])
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    conn.set_trace_callback(None)
+
+    return {
+        "updates": updates,
+        "throughput": round(updates / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "sql_per_update": round(len(statements) / updates, 2),
+        "api_per_update": round(sum(api.calls.values()) / updates, 2),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Печатает разницу с базовой линией; возвращает число регрессий."""
+    regressions = 0
+    print(f"\nСравнение с базовой линией (допуск {tolerance:.0f}%):")
+    for name, cur in results.items():
+        base = baseline["scenarios"].get(name)
+        if not base:
+            print(f"  {name}: нет в базовой линии")
+            continue
+        parts = []
+        for key, higher_is_better in (("throughput", True), ("p99_ms", False), ("sql_per_update", False)):
+            old, new = base[key], cur[key]
+            delta = (new - old) / old * 100 if old else 0.0
+            worse = -delta if higher_is_better else delta
+            flag = " ⚠️" if worse > tolerance else ""
+            regressions += bool(flag)
+            parts.append(f"{key} {old} → {new} ({delta:+.1f}%){flag}")
+        print(f"  {name}: " + "; ".join(parts))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000, help="пользователей в засеянной базе")
+    parser.add_argument("--updates", type=int, default=2000, help="апдейтов на сценарий")
+    parser.add_argument("--warmup", type=int, default=200, help="апдейтов прогрева (не замеряются)")
+    parser.add_argument("--scenario", action="append", help="запустить только эти сценарии")
+    parser.add_argument("--db", help="путь к базе; существующая переиспользуется без засева")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=10.0, help="допустимая регрессия, %%")
+    args = parser.parse_args()
+
+    api = RecordingApi()
+    apihelper.CUSTOM_REQUEST_SENDER = api
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.db")
+    users = prepare_db(path, args.users)
+
+    rng = random.Random(args.seed)
+    scenarios = make_scenarios(users, rng)
+    names = args.scenario or list(scenarios)
+    results = {}
+    print(f"{'сценарий':<16}{'апд/с':>10}{'p50 мс':>10}{'p99 мс':>10}{'SQL/апд':>10}{'API/апд':>10}")
+    for name in names:
+        res = results[name] = run_scenario(scenarios[name], args.updates, args.warmup, api)
+        print(f"{name:<16}{res['throughput']:>10}{res['p50_ms']:>10}{res['p99_ms']:>10}"
+              f"{res['sql_per_update']:>10}{res['api_per_update']:>10}")
+
+    report = {
+        "meta": {"users": users, "updates": args.updates, "python": platform.python_version(),
+                 "sqlite": sqlite3.sqlite_version, "created_at": datetime.now().isoformat()},
+        "scenarios": results,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Базовая линия сохранена: {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            if compare(results, json.load(f), args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
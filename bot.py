@@ -16,13 +16,692 @@ Karma Tracker Bot — v3.2 "max pack ++"
 import os
 import re
 import sys
+import argparse
+import asyncio
+import hmac
 import json
 import random
+import atexit
+import bisect
+import cProfile
+import functools
+import heapq
+import itertools
+import pstats
+import queue
 import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime, timedelta
 
 import telebot
-from telebot import types
+from telebot import apihelper, types
+
+# ===================== МЕТРИКИ =====================
+
+class Metrics:
+    """Счётчики и гистограммы в памяти, отдаются в формате Prometheus.
+
+    Всё пишется под одной блокировкой одним словарным обращением — дёшево
+    настолько, что остаётся включённым под нагрузкой. Метки — кортеж пар.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}      # name → (type, help, buckets)
+        self._counters = {}  # (name, labels) → value
+        self._hists = {}     # (name, labels) → [по бакетам..., sum, count]
+        self._gauges = []    # (name, функция → [(labels, value)])
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self._meta[name] = (kind, help_text, tuple(buckets or ()))
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        buckets = self._meta[name][2]
+        key = (name, labels)
+        with self._lock:
+            hist = self._hists.get(key)
+            if hist is None:
+                hist = self._hists[key] = [0] * (len(buckets) + 2)
+            hist[bisect.bisect_left(buckets, value)] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def add_gauges(self, name, help_text, collect):
+        self.describe(name, "gauge", help_text)
+        self._gauges.append((name, collect))
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                              for k, v in pairs) + "}"
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            hists = {key: list(h) for key, h in self._hists.items()}
+        samples = {}
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), hist in hists.items():
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self._meta[name][2] + (float("inf"),), hist):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{self._labels(labels, (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {hist[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {hist[-1]}")
+        for name, collect in self._gauges:
+            try:
+                samples[name] = [f"{name}{self._labels(labels)} {value}" for labels, value in collect()]
+            except Exception as e:
+                print(f"[metrics] gauge {name} failed: {e!r}")
+        out = []
+        for name in sorted(samples):
+            kind, help_text, _buckets = self._meta.get(name, ("untyped", "", ()))
+            out += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", *samples[name]]
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics()
+_SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+metrics.describe("trackbot_handler_seconds", "histogram", "Время обработки апдейта хэндлером", _SECONDS)
+metrics.describe("trackbot_handler_errors_total", "counter", "Исключения в хэндлерах")
+metrics.describe("trackbot_update_sql_statements", "histogram", "SQL-выражений на апдейт",
+                 (0, 1, 2, 3, 5, 8, 13, 21, 34, 55))
+metrics.describe("trackbot_update_db_connections_total", "counter", "Соединений с БД, открытых во время апдейта")
+metrics.describe("trackbot_sql_seconds", "histogram", "Время выполнения SQL-выражения", _SECONDS)
+metrics.describe("trackbot_db_connections_opened_total", "counter", "Открыто соединений с БД")
+metrics.describe("trackbot_telegram_request_seconds", "histogram", "Время запроса к Bot API", _SECONDS)
+metrics.describe("trackbot_telegram_errors_total", "counter", "Ошибки Bot API (code — HTTP/API код или network)")
+metrics.describe("trackbot_unhandled_updates_total", "counter", "Апдейты, которые никто не обработал")
+
+# контекст текущего апдейта в потоке-обработчике
+_update_ctx = threading.local()
+
+
+def instrument_handler(fn):
+    """Оборачивает хэндлер TeleBot: время, ошибки, SQL и соединения на апдейт.
+
+    Router переименовывает апдейт в имя реального хэндлера (note_handler),
+    так что метки — это habit_mark_progress, а не fallback.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(obj, *args, **kwargs):
+        _update_ctx.handler = fn.__name__
+        _update_ctx.sql = 0
+        _update_ctx.connections = 0
+        _update_ctx.active = True
+        prof = profiler
+        token = None
+        if prof:
+            try:
+                token = prof.begin()
+            except Exception as e:
+                # профилировщик не должен стоить апдейта
+                print(f"[profiler] begin failed: {e!r}")
+        started = time.perf_counter()
+        try:
+            return fn(obj, *args, **kwargs)
+        except Exception:
+            metrics.inc("trackbot_handler_errors_total", (("handler", _update_ctx.handler),))
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            _update_ctx.active = False
+            labels = (("handler", _update_ctx.handler),)
+            metrics.observe("trackbot_handler_seconds", elapsed, labels)
+            metrics.observe("trackbot_update_sql_statements", _update_ctx.sql, labels)
+            if _update_ctx.connections:
+                metrics.inc("trackbot_update_db_connections_total", labels, _update_ctx.connections)
+            if token is not None:
+                try:
+                    prof.end(token, _update_ctx.handler, obj, elapsed, _update_ctx.sql)
+                except Exception as e:
+                    print(f"[profiler] end failed: {e!r}")
+
+    return wrapper
+
+
+def note_handler(name):
+    if getattr(_update_ctx, "active", False):
+        _update_ctx.handler = name
+
+
+def _note_sql(elapsed):
+    metrics.observe("trackbot_sql_seconds", elapsed)
+    if getattr(_update_ctx, "active", False):
+        _update_ctx.sql += 1
+
+
+def _note_connection():
+    metrics.inc("trackbot_db_connections_opened_total")
+    if getattr(_update_ctx, "active", False):
+        _update_ctx.connections += 1
+
+
+def instrument_telegram_api():
+    """Считает время и ошибки каждого запроса к Bot API (синхронный apihelper)."""
+    make_request = apihelper._make_request
+    if getattr(make_request, "instrumented", False):
+        return
+
+    def metered(token, method_name, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return make_request(token, method_name, *args, **kwargs)
+        except apihelper.ApiTelegramException as e:
+            metrics.inc("trackbot_telegram_errors_total", (("method", method_name), ("code", e.error_code)))
+            raise
+        except Exception:
+            metrics.inc("trackbot_telegram_errors_total", (("method", method_name), ("code", "network")))
+            raise
+        finally:
+            metrics.observe("trackbot_telegram_request_seconds", time.perf_counter() - started,
+                            (("method", method_name),))
+
+    metered.instrumented = True
+    apihelper._make_request = metered
+
+
+class MetricsServer:
+    """Локальный HTTP-эндпоинт GET /metrics для Prometheus."""
+
+    def __init__(self, host, port):
+        self.httpd = ThreadingHTTPServer((host, port), self._Handler)
+        self.httpd.daemon_threads = True
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404); return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True).start()
+
+
+# ===================== ПРОФИЛИРОВАНИЕ =====================
+
+class SlowUpdateProfiler:
+    """Опциональный разбор медленных апдейтов и SQL (включается PROFILE_DIR).
+
+    - mode="sample": сторожевой поток раз в interval_ms снимает стеки
+      потоков, которые сейчас обрабатывают апдейт; если апдейт оказался
+      медленнее slow_update_ms, его стеки (свёрнутые, как для flamegraph)
+      пишутся в slow_updates.jsonl. Накладные расходы малы.
+    - mode="cprofile": апдейт идёт под cProfile, медленные сохраняются в
+      .prof рядом с записью в slow_updates.jsonl. Активным может быть только
+      один cProfile на процесс (с 3.12 второй enable() падает), поэтому под
+      ним идёт один апдейт за раз, а параллельные снимаются сэмплами. Дороже —
+      только для отладки.
+    В запись попадают имя хэндлера и callback data — не текст сообщений.
+    SQL медленнее slow_sql_ms пишется в slow_sql.jsonl: текст запроса, форма
+    параметров (типы, без значений) и EXPLAIN QUERY PLAN.
+    Отчёт по обоим журналам — slow_report.py.
+    """
+
+    MAX_STACK = 40
+
+    def __init__(self, directory, slow_update_ms=500, slow_sql_ms=50, mode="sample", interval_ms=10):
+        self.directory = directory
+        self.slow_update = slow_update_ms / 1000
+        self.slow_sql = slow_sql_ms / 1000
+        self.mode = mode
+        self.interval = interval_ms / 1000
+        self._lock = threading.Lock()
+        self._inflight = {}  # thread id → Counter свёрнутых стеков
+        self._plans = {}     # sql → план (EXPLAIN один раз на текст запроса)
+        self._cprofile_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _write(self, name, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            with open(os.path.join(self.directory, name), "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    # --- апдейты ---
+
+    def begin(self):
+        """Токен для end(): cProfile.Profile или Counter стеков."""
+        if self.mode == "cprofile" and self._cprofile_lock.acquire(blocking=False):
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+                return prof
+            except ValueError:
+                # занят другим инструментом (отладчик, coverage) — сэмплируем
+                self._cprofile_lock.release()
+        samples = Counter()
+        with self._lock:
+            self._inflight[threading.get_ident()] = samples
+        return samples
+
+    def end(self, token, handler, obj, elapsed, sql_count):
+        profiled = isinstance(token, cProfile.Profile)
+        if profiled:
+            token.disable()
+            self._cprofile_lock.release()
+        else:
+            with self._lock:
+                self._inflight.pop(threading.get_ident(), None)
+                # сэмплер пишет в Counter под тем же замком — снимок консистентен
+                stacks = dict(token)
+        if elapsed < self.slow_update:
+            return
+        record = {
+            "ts": datetime.now().isoformat(timespec="milliseconds"),
+            "handler": handler,
+            "data": getattr(obj, "data", None),
+            "user_id": getattr(getattr(obj, "from_user", None), "id", None),
+            "elapsed_ms": round(elapsed * 1000, 1),
+            "sql": sql_count,
+        }
+        if profiled:
+            path = os.path.join(self.directory, f"update-{int(time.time() * 1000)}-{handler}.prof")
+            token.dump_stats(path)
+            record["prof"] = os.path.basename(path)
+            stats = pstats.Stats(token).sort_stats("cumulative")
+            record["top"] = [[f"{os.path.basename(fn)}:{line}:{name}", nc, round(tt * 1000, 2), round(ct * 1000, 2)]
+                             for (fn, line, name), (_cc, nc, tt, ct, _callers) in
+                             sorted(stats.stats.items(), key=lambda kv: kv[1][3], reverse=True)[:25]]
+        else:
+            record["stacks"] = dict(sorted(stacks.items(), key=lambda kv: -kv[1]))
+        self._write("slow_updates.jsonl", record)
+
+    def _fold(self, frame):
+        parts = []
+        while frame is not None and len(parts) < self.MAX_STACK:
+            code = frame.f_code
+            parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        return ";".join(reversed(parts))
+
+    def _sample_forever(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                inflight = list(self._inflight.items())
+            if not inflight:
+                continue
+            frames = sys._current_frames()
+            folded = [(samples, self._fold(frames[tid])) for tid, samples in inflight if tid in frames]
+            with self._lock:
+                for samples, stack in folded:
+                    samples[stack] += 1
+
+    # --- SQL ---
+
+    def sql_done(self, conn, sql, parameters, elapsed, many=False):
+        if elapsed < self.slow_sql:
+            return
+        text = " ".join(sql.split())
+        plan = self._plans.get(text)
+        if plan is None and re.match(r"(SELECT|INSERT|UPDATE|DELETE|WITH)\b", text, re.IGNORECASE):
+            try:
+                # Connection.execute минует _MeteredCursor — без рекурсии в метрики
+                plan = [row[3] for row in sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql,
+                                                                      parameters if not many else ())]
+            except sqlite3.Error as e:
+                plan = [f"explain failed: {e}"]
+            self._plans[text] = plan
+        self._write("slow_sql.jsonl", {
+            "ts": datetime.now().isoformat(timespec="milliseconds"),
+            "handler": getattr(_update_ctx, "handler", None) if getattr(_update_ctx, "active", False) else None,
+            "sql": text,
+            "params": "executemany" if many else _params_shape(parameters),
+            "elapsed_ms": round(elapsed * 1000, 2),
+            "plan": plan,
+        })
+
+    def start(self):
+        # в режиме cprofile сэмплер тоже нужен — для апдейтов, не попавших под cProfile
+        threading.Thread(target=self._sample_forever, name="profiler", daemon=True).start()
+
+
+def _params_shape(parameters):
+    """Типы параметров без значений: ['int', 'str[12]', 'None'] или {'user_id': 'int'}."""
+
+    def shape(v):
+        if isinstance(v, (str, bytes)):
+            return f"{type(v).__name__}[{len(v)}]"
+        return type(v).__name__
+
+    if isinstance(parameters, dict):
+        return {k: shape(v) for k, v in parameters.items()}
+    return [shape(v) for v in parameters]
+
+
+profiler = None  # SlowUpdateProfiler, если задан PROFILE_DIR (см. start_profiler)
+
+
+# ===================== ДИСПЕТЧЕР АПДЕЙТОВ =====================
+
+def update_user_id(update):
+    """id отправителя апдейта (ключ шардирования); без отправителя — update_id."""
+    for kind in ("message", "callback_query", "pre_checkout_query", "edited_message"):
+        obj = getattr(update, kind, None)
+        if obj is not None and getattr(obj, "from_user", None) is not None:
+            return obj.from_user.id
+    return update.update_id
+
+
+class UpdateDispatcher:
+    """Пул из N воркеров с собственной очередью у каждого.
+
+    Апдейт попадает в шард user_id % N, поэтому апдейты одного пользователя
+    обрабатываются строго по очереди (нет гонок в user_states и
+    read-modify-write), а разные пользователи — параллельно в разных шардах.
+    """
+
+    def __init__(self, process, shards):
+        self.process = process
+        self.queues = [queue.Queue() for _ in range(shards)]
+        self._lock = threading.Lock()
+        self._processed = [0] * shards
+        self._wait_total = [0.0] * shards
+        self._busy_total = [0.0] * shards
+        self._busy_max = [0.0] * shards
+        self.running = False
+
+    def submit(self, updates):
+        now = time.perf_counter()
+        for update in updates:
+            self.queues[update_user_id(update) % len(self.queues)].put((now, update))
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        for i in range(len(self.queues)):
+            threading.Thread(target=self._work, args=(i,), name=f"shard-{i}", daemon=True).start()
+
+    def _work(self, i):
+        q = self.queues[i]
+        while True:
+            queued_at, update = q.get()
+            started = time.perf_counter()
+            try:
+                self.process(update)
+            except Exception as e:
+                print(f"[shard-{i}] update {update.update_id} failed: {e!r}")
+            finished = time.perf_counter()
+            with self._lock:
+                self._processed[i] += 1
+                self._wait_total[i] += started - queued_at
+                self._busy_total[i] += finished - started
+                self._busy_max[i] = max(self._busy_max[i], finished - started)
+
+    def stats(self):
+        """Глубина очереди и задержки по шардам (время в мс)."""
+        with self._lock:
+            return [{
+                "shard": i,
+                "depth": q.qsize(),
+                "processed": n,
+                "avg_wait_ms": round(self._wait_total[i] / n * 1000, 2) if n else 0.0,
+                "avg_handle_ms": round(self._busy_total[i] / n * 1000, 2) if n else 0.0,
+                "max_handle_ms": round(self._busy_max[i] * 1000, 2),
+            } for i, (q, n) in enumerate(zip(self.queues, self._processed))]
+
+    def log_stats_forever(self, every):
+        while True:
+            time.sleep(every)
+            for st in self.stats():
+                print("[dispatch] " + " ".join(f"{k}={v}" for k, v in st.items()))
+
+
+class ShardedTeleBot(telebot.TeleBot):
+    """TeleBot, который раздаёт апдейты по шардам UpdateDispatcher вместо общего пула.
+
+    Хэндлеры выполняются синхронно внутри воркера шарда (threaded=False), а
+    send_message уходит в Outbox и не ждёт сеть. Пока диспетчер/Outbox не
+    запущены (скрипты, бенчмарки), всё выполняется на месте.
+    """
+
+    def __init__(self, token, shards=8, outbox=None, **kwargs):
+        super().__init__(token, threaded=False, **kwargs)
+        self.dispatcher = UpdateDispatcher(self._process_one, shards)
+        self.outbox = Outbox(self._send_now, **(outbox or {}))
+
+    def send_message(self, chat_id, text, **kwargs):
+        if not self.outbox.running:
+            return super().send_message(chat_id, text, **kwargs)
+        self.outbox.send(chat_id, text, **kwargs)
+
+    def _send_now(self, chat_id, text, **kwargs):
+        return super().send_message(chat_id, text, **kwargs)
+
+    # все хэндлеры регистрируются через эти методы — здесь же их и оборачиваем метриками
+    def add_message_handler(self, handler_dict):
+        super().add_message_handler(dict(handler_dict, function=instrument_handler(handler_dict["function"])))
+
+    def add_callback_query_handler(self, handler_dict):
+        super().add_callback_query_handler(dict(handler_dict, function=instrument_handler(handler_dict["function"])))
+
+    def add_pre_checkout_query_handler(self, handler_dict):
+        super().add_pre_checkout_query_handler(
+            dict(handler_dict, function=instrument_handler(handler_dict["function"])))
+
+    def process_new_updates(self, updates):
+        if not self.dispatcher.running:
+            return super().process_new_updates(updates)
+        if updates:
+            # offset для getUpdates двигает только TeleBot.process_new_updates — здесь
+            # двигаем сами, иначе polling перезапросит апдейты, пока они ждут в шардах
+            self.last_update_id = max(self.last_update_id, max(u.update_id for u in updates))
+        self.dispatcher.submit(updates)
+
+    def _process_one(self, update):
+        super().process_new_updates([update])
+
+
+# ===================== ИСХОДЯЩИЕ СООБЩЕНИЯ =====================
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше burst про запас."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now):
+        """Через сколько секунд будет доступен токен (0 — уже есть)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _OutMessage:
+    __slots__ = ("chat_id", "text", "kwargs", "queued_at", "callbacks")
+
+    def __init__(self, chat_id, text, kwargs, queued_at, on_sent):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.queued_at = queued_at
+        self.callbacks = [on_sent] if on_sent else []
+
+
+class _OutChat:
+    __slots__ = ("queue", "bucket", "busy")
+
+    def __init__(self, bucket):
+        self.queue = deque()
+        self.bucket = bucket
+        self.busy = False
+
+
+class Outbox:
+    """Очередь исходящих sendMessage с лимитами Telegram.
+
+    send() только ставит сообщение в очередь и сразу возвращает управление.
+    Отправители берут сообщения с учётом общего лимита (global_rate/с) и
+    лимита на чат (chat_rate/с); сообщения одного чата уходят строго по
+    порядку. Идущие подряд сообщения в один чат, пока они ждут очереди и
+    укладываются в coalesce_ms и MAX_TEXT, склеиваются в одно — если у
+    предыдущего нет клавиатуры. На 429 чат откладывается на retry_after.
+    transport(chat_id, text, **kwargs) — фактическая отправка; on_sent(error)
+    вызывается в потоке отправителя после окончательного исхода (error=None — доставлено).
+    """
+
+    MAX_TEXT = 4096
+    SEPARATOR = "\n\n"
+
+    def __init__(self, transport, global_rate=30, chat_rate=1, coalesce_ms=1000, senders=4):
+        self.transport = transport
+        self.chat_rate = chat_rate
+        self.coalesce = coalesce_ms / 1000
+        self.senders = senders
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._ready = []  # heap (не раньше, seq, chat_id) — чаты с ожидающими сообщениями
+        self._seq = itertools.count()
+        self._cv = threading.Condition()
+        self.counters = {"queued": 0, "sent": 0, "merged": 0, "retried": 0, "failed": 0}
+        self.running = False
+
+    def send(self, chat_id, text, on_sent=None, **kwargs):
+        now = time.monotonic()
+        with self._cv:
+            self.counters["queued"] += 1
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _OutChat(TokenBucket(self.chat_rate, 1))
+            tail = chat.queue[-1] if chat.queue else None
+            if tail is not None and self._can_merge(tail, text, kwargs, now):
+                tail.text += self.SEPARATOR + text
+                tail.kwargs = kwargs
+                if on_sent:
+                    tail.callbacks.append(on_sent)
+                self.counters["merged"] += 1
+                return
+            chat.queue.append(_OutMessage(chat_id, text, kwargs, now, on_sent))
+            if len(chat.queue) == 1 and not chat.busy:
+                self._schedule(chat_id, now)
+
+    def _can_merge(self, tail, text, kwargs, now):
+        if "reply_markup" in tail.kwargs or now - tail.queued_at > self.coalesce:
+            return False
+        if {k: v for k, v in kwargs.items() if k != "reply_markup"} != tail.kwargs:
+            return False
+        return len(tail.text) + len(self.SEPARATOR) + len(text) <= self.MAX_TEXT
+
+    def _schedule(self, chat_id, at):
+        heapq.heappush(self._ready, (at, next(self._seq), chat_id))
+        self._cv.notify()
+
+    def _take(self):
+        """Ждёт, пока какой-нибудь чат можно обслужить, и забирает его голову очереди."""
+        with self._cv:
+            while True:
+                now = time.monotonic()
+                wait = None
+                if self._ready:
+                    wait = max(self._ready[0][0] - now, self._global.delay(now))
+                    if wait <= 0:
+                        _at, _seq, chat_id = heapq.heappop(self._ready)
+                        chat = self._chats.get(chat_id)
+                        if chat is None or chat.busy:
+                            continue
+                        chat_wait = chat.bucket.delay(now)
+                        if chat_wait > 0:
+                            self._schedule(chat_id, now + chat_wait)
+                            continue
+                        if not chat.queue:
+                            # лимит чата восстановился, а писать нечего — забываем чат
+                            del self._chats[chat_id]
+                            continue
+                        self._global.take(now)
+                        chat.bucket.take(now)
+                        chat.busy = True
+                        return chat.queue.popleft()
+                self._cv.wait(wait)
+
+    def _done(self, msg, retry_after=None, error=None):
+        now = time.monotonic()
+        with self._cv:
+            # счётчики — под тем же замком: отправителей несколько
+            if retry_after is not None:
+                self.counters["retried"] += 1
+            else:
+                self.counters["failed" if error is not None else "sent"] += 1
+            chat = self._chats[msg.chat_id]
+            chat.busy = False
+            if retry_after is not None:
+                chat.queue.appendleft(msg)
+                self._schedule(msg.chat_id, now + retry_after)
+            else:
+                # пустой чат тоже ставим в очередь — его уберут, когда восстановится лимит
+                self._schedule(msg.chat_id, now)
+
+    def _work(self):
+        while True:
+            msg = self._take()
+            retry_after = error = None
+            try:
+                self.transport(msg.chat_id, msg.text, **msg.kwargs)
+            except apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+                else:
+                    error = e
+            except Exception as e:
+                error = e
+            if error is not None:
+                print(f"[outbox] send to {msg.chat_id} failed: {error!r}")
+            self._done(msg, retry_after, error)
+            if retry_after is None:
+                for fn in msg.callbacks:
+                    try:
+                        fn(error)
+                    except Exception as e:
+                        print(f"[outbox] on_sent failed: {e!r}")
+
+    def stats(self):
+        with self._cv:
+            return dict(self.counters, depth=sum(len(c.queue) for c in self._chats.values()),
+                        chats=len(self._chats))
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        for i in range(self.senders):
+            threading.Thread(target=self._work, name=f"outbox-{i}", daemon=True).start()
+
 
 # ===================== НАСТРОЙКИ =====================
 
@@ -45,28 +724,202 @@ BOT_TOKEN = "6396361025:AAFUBxVyMDOIK5IxfVdBUp8PbpTRLmObWE8"
 PROVIDER_TOKEN = ""
 PAYMENTS_AVAILABLE = bool(PROVIDER_TOKEN)
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+UPDATE_SHARDS = int(_get_env_value("UPDATE_SHARDS", "8"))  # воркеров-шардов для апдейтов
+DISPATCH_STATS_EVERY = int(_get_env_value("DISPATCH_STATS_EVERY", "0"))  # сек, 0 — не логировать
+OUTBOX_GLOBAL_RATE = 30   # сообщений в секунду на бота (лимит Telegram)
+OUTBOX_CHAT_RATE = 1      # сообщений в секунду в один чат
+OUTBOX_COALESCE_MS = 1000 # окно склейки подряд идущих сообщений в один чат
+OUTBOX_SENDERS = 4        # параллельных HTTP-отправок
+bot = ShardedTeleBot(BOT_TOKEN, parse_mode="HTML", shards=UPDATE_SHARDS, outbox=dict(
+    global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE,
+    coalesce_ms=OUTBOX_COALESCE_MS, senders=OUTBOX_SENDERS))
+BOT_MODE = _get_env_value("BOT_MODE", "polling")  # polling | async | webhook
+ASYNC_DB_WORKERS = 8  # потоков для синхронных хэндлеров/БД в asyncio-режиме
+ALLOWED_UPDATES = ['message', 'callback_query']
+
+# webhook: локальный HTTP-сервер за reverse proxy с TLS
+WEBHOOK_URL = _get_env_value("WEBHOOK_URL")          # публичный адрес для setWebhook
+WEBHOOK_SECRET = _get_env_value("WEBHOOK_SECRET")    # X-Telegram-Bot-Api-Secret-Token, обязателен
+WEBHOOK_HOST = _get_env_value("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(_get_env_value("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_BATCH_SIZE = 100
+WEBHOOK_BATCH_MS = 20
+WEBHOOK_MAX_BODY = 1 << 20  # апдейт Telegram на порядки меньше; больше — 413
+
+# локальная отладка: адрес поддельного Bot API (см. fake_telegram.py)
+TELEGRAM_API_URL = _get_env_value("TELEGRAM_API_URL")
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL
+instrument_telegram_api()
+
+# Prometheus: GET http://METRICS_HOST:METRICS_PORT/metrics; порт 0 — выключено
+METRICS_HOST = _get_env_value("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(_get_env_value("METRICS_PORT", "9108"))
+
+# профилирование медленного (см. SlowUpdateProfiler, отчёт — slow_report.py); пустой PROFILE_DIR — выключено
+PROFILE_DIR = _get_env_value("PROFILE_DIR")
+PROFILE_MODE = _get_env_value("PROFILE_MODE", "sample")  # sample | cprofile
+PROFILE_SLOW_UPDATE_MS = int(_get_env_value("PROFILE_SLOW_UPDATE_MS", "500"))
+PROFILE_SLOW_SQL_MS = int(_get_env_value("PROFILE_SLOW_SQL_MS", "50"))
 
 DB_PATH = "karma_bot.db"
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHED_STATEMENTS = 256  # кэш подготовленных выражений на соединение
 REF_BONUS = 50
 DAILY_MIN, DAILY_MAX = 10, 50
+DAILY_STREAK_HOURS = 48    # серия не прерывается, если следующая награда взята в пределах N часов
+DAILY_STREAK_STEP_PCT = 10  # +N% к награде за каждый день серии…
+DAILY_STREAK_MAX_DAYS = 7   # …но не больше, чем за столько дней
 KARMA_PER_HABIT_COMPLETE = 50
 KARMA_FOR_PUBLIC_JOIN = 10
 LEVEL_BORDER = 100
 COMMISSION_PCT = 15  # комиссия с призового фонда (виртуально)
-
-user_states = {}  # простая FSM
+LEADERBOARD_TOP = 10
+DUE_RETRY_SEC = 5  # повтор дедлайнов/истечений премиума после ошибки
+MY_CHALLENGES_PAGE = 10
+PUBLIC_CHALLENGES_PAGE = 5
+CATALOG_CACHE_PAGES = 64   # отрисованных страниц публичного каталога в памяти
+CATALOG_DESC_MAX = 120     # описание в каталоге обрезается, полное — в деталях
+CARD_CACHE_SIZE = 5000     # отрисованных карточек челленджей в памяти
+USER_CACHE_SIZE = 50000  # профилей пользователей в памяти (LRU)
+FSM_TTL_SEC = 24 * 3600        # брошенный мастер создания забывается через сутки
+FSM_MAX_IN_MEMORY = 10000      # LRU-лимит состояний в памяти
+FSM_PERSIST = _get_env_value("FSM_PERSIST", "1") == "1"  # хранить состояния в SQLite
+FSM_FLUSH_MS = 500
+NOTIFY_CHUNK = 200          # уведомлений в Outbox одновременно
+NOTIFY_POLL_SEC = 5         # страховочный опрос неотправленных
+NOTIFY_KEEP_DAYS = 30       # отправленные уведомления (ключи дедупликации) храним N дней
+NOTIFY_PURGE_SEC = 3600     # как часто чистить устаревшие
 
 # ===================== УТИЛИТЫ БД =====================
 
+_db_local = threading.local()
+
+
+class _MeteredCursor(sqlite3.Cursor):
+    """Курсор, который отмечает каждое выражение в метриках (время и счётчик на апдейт)."""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            _note_sql(elapsed)
+            if profiler:
+                profiler.sql_done(self.connection, sql, parameters, elapsed)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            _note_sql(elapsed)
+            if profiler:
+                profiler.sql_done(self.connection, sql, (), elapsed, many=True)
+
+
+class _MeteredConnection(sqlite3.Connection):
+    # conn.execute() минует Cursor.execute, поэтому хелперы ниже ходят через cursor()
+    def cursor(self, factory=_MeteredCursor):
+        return super().cursor(factory)
+
+
+def _open_connection():
+    """Открывает соединение и один раз настраивает его (WAL, NORMAL, busy_timeout)."""
+
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=DB_CACHED_STATEMENTS,
+        factory=_MeteredConnection,
+    )
+    _note_connection()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    return conn
+
+
 def db():
-    return sqlite3.connect(DB_PATH)
+    """Долгоживущее соединение текущего потока: открывается один раз и переиспользуется."""
+
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = _db_local.conn = _open_connection()
+        _db_local.tx_depth = 0
+        _db_local.on_commit = []
+    return conn
+
+
+@contextmanager
+def transaction():
+    """Объединяет несколько запросов в одну транзакцию с одним commit.
+
+    Вложенные вызовы (и execute() внутри) не коммитят сами — фиксирует внешний блок.
+    """
 
-def init_db():
     conn = db()
-    c = conn.cursor()
+    _db_local.tx_depth += 1
+    try:
+        yield conn.cursor()
+    except BaseException:
+        _db_local.tx_depth -= 1
+        if _db_local.tx_depth == 0:
+            conn.rollback()
+            _db_local.on_commit.clear()
+        raise
+    _db_local.tx_depth -= 1
+    if _db_local.tx_depth == 0:
+        callbacks, _db_local.on_commit = _db_local.on_commit, []
+        try:
+            conn.commit()
+        except BaseException:
+            # не зафиксировалось — транзакцию закрываем, отложенные вызовы не нужны
+            conn.rollback()
+            raise
+        for fn in callbacks:
+            fn()
+
+
+def after_commit(fn):
+    """Вызывает fn после фиксации текущей транзакции (или сразу, если её нет).
+
+    При откате отложенные вызовы отбрасываются — кэши не увидят
+    изменений, которых нет в базе.
+    """
+
+    db()
+    if _db_local.tx_depth:
+        _db_local.on_commit.append(fn)
+    else:
+        fn()
+
+
+# ===================== МИГРАЦИИ =====================
+# Схема версионируется через PRAGMA user_version: миграция N применяется
+# один раз и поднимает версию до N. Новые изменения схемы — только новой
+# функцией в конце MIGRATIONS. Ранние миграции идемпотентны (IF NOT EXISTS),
+# потому что базы до версионирования уже содержат часть этих таблиц.
+
+def json_load(s, default):
+    try:
+        return json.loads(s) if s else default
+    except Exception:
+        return default
+
+
+def add_missing_columns(cursor, table, columns):
+    """Добавляет отсутствующие столбцы; структура таблицы читается один раз."""
+    existing = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+    for column, ddl_type in columns:
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}")
+
 
-    # базовые таблицы
+def _m001_base_schema(c):
     c.execute("""
     CREATE TABLE IF NOT EXISTS users(
         user_id INTEGER PRIMARY KEY,
@@ -99,7 +952,7 @@ def init_db():
         creator_id INTEGER,
         target TEXT,                        -- legacy (оставляем)
         prize_pool INTEGER DEFAULT 0,
-        participants TEXT,                  -- JSON: {user_id: progress_int}
+        participants TEXT,                  -- legacy JSON, перенесено в challenge_participants
         is_premium INTEGER DEFAULT 0,
         is_public INTEGER DEFAULT 1,
         created_at TEXT,
@@ -128,57 +981,183 @@ def init_db():
         created_at TEXT
     )""")
 
-    # мягкие миграции (на случай старых баз)
-    safe_add_column(c, "users", "premium_until", "TEXT")
-    safe_add_column(c, "challenges", "status", "TEXT")
-    safe_add_column(c, "challenges", "target_count", "INTEGER")
-    safe_add_column(c, "challenges", "deadline", "TEXT")
-    safe_add_column(c, "challenges", "winners", "TEXT")
-    safe_add_column(c, "challenges", "is_public", "INTEGER DEFAULT 1")
-    safe_add_column(c, "challenges", "created_at", "TEXT")
+    # столбцы, которых нет в совсем старых базах
+    add_missing_columns(c, "users", [
+        ("is_premium", "INTEGER DEFAULT 0"),
+        ("premium_until", "TEXT"),
+        ("last_daily_claim", "TEXT"),
+        ("referrer_id", "INTEGER"),
+    ])
+    add_missing_columns(c, "challenges", [
+        ("status", "TEXT"),
+        ("target_count", "INTEGER"),
+        ("deadline", "TEXT"),
+        ("winners", "TEXT"),
+        ("is_public", "INTEGER DEFAULT 1"),
+        ("created_at", "TEXT"),
+    ])
+
+
+def _m002_challenge_participants(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS challenge_participants(
+        challenge_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        progress INTEGER NOT NULL DEFAULT 0,
+        joined_at TEXT,
+        PRIMARY KEY (challenge_id, user_id)
+    ) WITHOUT ROWID""")
+    # победители: WHERE challenge_id=? AND progress>=? — без чтения всех строк челленджа
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_challenge_participants_progress
+                 ON challenge_participants(challenge_id, progress)""")
+    # «мои челленджи»: участие и создание ищутся по индексу, а не перебором всех челленджей
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_challenge_participants_user
+                 ON challenge_participants(user_id, challenge_id)""")
+
+    # перенос участников из JSON challenges.participants; JSON обнуляется
+    rows = c.execute("""SELECT id, participants, created_at FROM challenges
+                        WHERE participants IS NOT NULL AND participants NOT IN ('', '{}')""").fetchall()
+    for chl_id, participants_json, created_at in rows:
+        participants = json_load(participants_json, {})
+        c.executemany(
+            "INSERT OR IGNORE INTO challenge_participants (challenge_id, user_id, progress, joined_at) "
+            "VALUES (?, ?, ?, ?)",
+            [(chl_id, int(uid), int(prog or 0), created_at) for uid, prog in participants.items()]
+        )
+        c.execute("UPDATE challenges SET participants=NULL WHERE id=?", (chl_id,))
 
-    conn.commit()
-    conn.close()
 
-def safe_add_column(cursor, table, column, ddl_type):
-    cursor.execute("PRAGMA table_info(%s)" % table)
-    cols = [row[1] for row in cursor.fetchall()]
-    if column not in cols:
-        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}")
+def _m003_karma_ledger(c):
+    # append-only журнал начислений кармы; users.karma/level — материализованный итог
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS karma_events(
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,            -- запрошенная сумма
+        credited INTEGER NOT NULL,          -- фактически начислено (с премиум-множителем)
+        reason TEXT,
+        created_at TEXT
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_karma_events_user ON karma_events(user_id, id)")
 
+    # баланс, накопленный до журнала, записывается как opening_balance —
+    # пересборка итогов из журнала его не теряет
+    if c.execute("SELECT 1 FROM karma_events LIMIT 1").fetchone():
+        return
+    c.execute(f"""
+        INSERT INTO karma_events (user_id, amount, credited, reason, created_at)
+        SELECT user_id, total, total, 'opening_balance', ?
+        FROM (SELECT user_id, (COALESCE(level, 1) - 1) * {LEVEL_BORDER} + COALESCE(karma, 0) AS total
+              FROM users)
+        WHERE total <> 0""", (datetime.now().isoformat(),))
 
-def fix_missing_columns():
-    """Явно добавляет отсутствующие столбцы"""
-    conn = db()
-    c = conn.cursor()
 
-    # Добавляем все возможные отсутствующие столбцы
-    columns_to_add = [
-        ("users", "is_premium", "INTEGER DEFAULT 0"),
-        ("users", "premium_until", "TEXT"),
-        ("users", "last_daily_claim", "TEXT"),
-        ("users", "referrer_id", "INTEGER"),
-        ("challenges", "status", "TEXT"),
-        ("challenges", "target_count", "INTEGER"),
-        ("challenges", "deadline", "TEXT"),
-        ("challenges", "winners", "TEXT"),
-        ("challenges", "is_public", "INTEGER DEFAULT 1"),
-        ("challenges", "created_at", "TEXT")
-    ]
+def _m004_fsm_states(c):
+    # состояния FSM (см. StateStore); data — JSON, expires_at — unix time
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_states(
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_expires ON fsm_states(expires_at)")
+
+
+def _m005_notifications(c):
+    # исходящие уведомления (см. Notifier); UNIQUE — не больше одного на (событие, пользователь)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS notifications(
+        id INTEGER PRIMARY KEY,
+        event_key TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        created_at TEXT,
+        sent_at TEXT,                       -- NULL — ещё не отправлено
+        error TEXT,
+        UNIQUE (event_key, user_id)
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notifications_pending ON notifications(id) WHERE sent_at IS NULL")
+
+
+def _m006_lookup_indexes(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_challenges_creator ON challenges(creator_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_rank ON users(level DESC, karma DESC)")
+    # привычки и ачивки всегда читаются по владельцу
+    c.execute("CREATE INDEX IF NOT EXISTS idx_habits_user ON habits(user_id, is_done)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_achievements_user ON achievements(user_id)")
+
+
+def _m007_catalog_indexes(c):
+    # status больше не бывает NULL — запросы сравнивают его напрямую и попадают в индекс
+    c.execute("UPDATE challenges SET status='active' WHERE status IS NULL")
+    # публичный каталог: WHERE is_public=1 AND status='active' ORDER BY id DESC
+    c.execute("CREATE INDEX IF NOT EXISTS idx_challenges_public ON challenges(is_public, status, id)")
+    # загрузка дедлайнов и истекающих премиумов при старте — по частичным индексам
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_challenges_deadline ON challenges(deadline)
+                 WHERE status='active' AND deadline IS NOT NULL""")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_users_premium ON users(premium_until)
+                 WHERE is_premium=1 AND premium_until IS NOT NULL""")
+    # чистка старых отправленных уведомлений
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notifications_sent ON notifications(sent_at) WHERE sent_at IS NOT NULL")
+
+
+def _m008_user_counters(c):
+    # счётчики для экрана статистики; дальше их ведут пути записи (привычки, ачивки, челленджи, карма)
+    add_missing_columns(c, "users", [
+        ("habits_total", "INTEGER NOT NULL DEFAULT 0"),
+        ("habits_done", "INTEGER NOT NULL DEFAULT 0"),
+        ("achievements_count", "INTEGER NOT NULL DEFAULT 0"),
+        ("challenges_joined", "INTEGER NOT NULL DEFAULT 0"),
+        ("challenges_won", "INTEGER NOT NULL DEFAULT 0"),
+        ("karma_earned", "INTEGER NOT NULL DEFAULT 0"),
+    ])
+    c.execute("""
+        UPDATE users SET
+            habits_total = (SELECT COUNT(*) FROM habits h WHERE h.user_id = users.user_id),
+            habits_done = (SELECT COUNT(*) FROM habits h WHERE h.user_id = users.user_id AND h.is_done = 1),
+            achievements_count = (SELECT COUNT(*) FROM achievements a WHERE a.user_id = users.user_id),
+            challenges_joined = (SELECT COUNT(*) FROM challenge_participants p WHERE p.user_id = users.user_id),
+            karma_earned = COALESCE((SELECT SUM(credited) FROM karma_events k
+                                     WHERE k.user_id = users.user_id AND k.credited > 0), 0)""")
+    # победители хранятся JSON-массивом в challenges.winners
+    c.execute("""
+        UPDATE users SET challenges_won = w.cnt
+        FROM (SELECT CAST(j.value AS INTEGER) AS user_id, COUNT(*) AS cnt
+              FROM challenges, json_each(challenges.winners) j
+              WHERE challenges.status = 'finished' AND json_valid(challenges.winners)
+              GROUP BY 1) AS w
+        WHERE users.user_id = w.user_id""")
+
 
-    for table, column, ddl_type in columns_to_add:
-        safe_add_column(c, table, column, ddl_type)
+def _m009_daily_streak(c):
+    # серия ежедневных наград; ведётся тем же UPDATE, что и last_daily_claim
+    add_missing_columns(c, "users", [("daily_streak", "INTEGER NOT NULL DEFAULT 0")])
 
-    conn.commit()
-    conn.close()
-    print("✅ Проверка и добавление отсутствующих столбцов завершено")
 
+MIGRATIONS = [
+    _m001_base_schema,
+    _m002_challenge_participants,
+    _m003_karma_ledger,
+    _m004_fsm_states,
+    _m005_notifications,
+    _m006_lookup_indexes,
+    _m007_catalog_indexes,
+    _m008_user_counters,
+    _m009_daily_streak,
+]
 
-# Вызовите после init_db()
-init_db()
-fix_missing_columns()
 
-init_db()
+def init_db():
+    """Доводит схему до последней версии. Для актуальной базы — одно чтение PRAGMA user_version."""
+    conn = db()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migrate in enumerate(MIGRATIONS[version:], version + 1):
+        with transaction() as c:
+            c.execute("BEGIN")  # DDL тоже внутри транзакции: миграция применяется целиком или никак
+            migrate(c)
+            c.execute(f"PRAGMA user_version = {number}")
+        print(f"✅ Миграция {number}: {migrate.__name__}")
+
 
 # ===================== ХЕЛПЕРЫ =====================
 
@@ -192,64 +1171,355 @@ def dt_from_iso(s):
         return None
 
 def fetch_one(query, args=()):
-    conn = db(); c = conn.cursor()
-    c.execute(query, args)
-    row = c.fetchone()
-    conn.close()
-    return row
+    return db().cursor().execute(query, args).fetchone()
 
 def fetch_all(query, args=()):
-    conn = db(); c = conn.cursor()
-    c.execute(query, args)
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return db().cursor().execute(query, args).fetchall()
 
 def execute(query, args=()):
-    conn = db(); c = conn.cursor()
-    c.execute(query, args)
-    conn.commit()
-    conn.close()
-
-def json_load(s, default):
+    """Выполняет запрос и коммитит, если мы не внутри transaction(). Возвращает курсор."""
+    conn = db()
     try:
-        return json.loads(s) if s else default
+        cur = conn.cursor().execute(query, args)
     except Exception:
-        return default
+        # соединение долгоживущее — не оставляем после ошибки висящую транзакцию
+        if not _db_local.tx_depth:
+            conn.rollback()
+        raise
+    if not _db_local.tx_depth:
+        conn.commit()
+    return cur
+
+class UserCache:
+    """LRU профилей пользователей (user_id → username).
+
+    Промахи догружаются пачкой WHERE user_id IN (...). Отсутствующие в users
+    id тоже кэшируются (как None), чтобы не спрашивать базу повторно.
+    """
+
+    def __init__(self, max_items=USER_CACHE_SIZE):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, user_id, username):
+        with self._lock:
+            self._items[user_id] = username
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def get_many(self, user_ids):
+        """{user_id: username или None} одним запросом на каждые 500 промахов."""
+        found, missing = {}, []
+        with self._lock:
+            for uid in dict.fromkeys(user_ids):
+                if uid in self._items:
+                    self._items.move_to_end(uid)
+                    found[uid] = self._items[uid]
+                else:
+                    missing.append(uid)
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            rows = dict(fetch_all(f"SELECT user_id, username FROM users WHERE user_id IN "
+                                  f"({','.join('?' * len(chunk))})", chunk))
+            for uid in chunk:
+                found[uid] = rows.get(uid)
+                self._remember(uid, rows.get(uid))
+        return found
+
+    def username(self, user_id):
+        return self.get_many([user_id])[user_id]
+
+    def ensure(self, user_id, username):
+        """Заводит пользователя или обновляет username; известный и не изменившийся — без записи."""
+        known = self.get_many([user_id])[user_id]
+        if known == username:
+            return
+        if known is None:
+            cur = execute("INSERT OR IGNORE INTO users (user_id, username, created_date) VALUES (?, ?, ?)",
+                          (user_id, username, now_iso()))
+            if cur.rowcount:
+                leaderboard_index.update(user_id, 1, 0)
+        else:
+            execute("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
+            leaderboard_index.invalidate_top()
+        self._remember(user_id, username)
+
+
+user_cache = UserCache()
+
 
 def ensure_user(message):
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name or "noname"
-    execute(
-        "INSERT OR IGNORE INTO users (user_id, username, created_date) VALUES (?, ?, ?)",
-        (user_id, username, now_iso())
-    )
+    user_cache.ensure(user_id, username)
     return user_id, username
 
 
-def compute_is_premium(user_id) -> bool:
-    try:
-        row = fetch_one("SELECT is_premium, premium_until FROM users WHERE user_id=?", (user_id,))
-        if not row:
-            return False
+class DueHeap:
+    """Min-куча (срок, ключ) с фоновым потоком, который спит до ближайшего срока.
+
+    Когда сроки наступают, поток снимает с кучи все просроченные ключи и одной
+    пачкой передаёт их в on_due(keys, now). Никакого опроса по запросам.
+    Если on_due упал (например, database is locked), ключи возвращаются в
+    кучу со сроком через retry_sec и будут обработаны повторно.
+    """
+
+    def __init__(self, name, on_due, retry_sec=DUE_RETRY_SEC):
+        self.name = name
+        self.on_due = on_due
+        self.retry = timedelta(seconds=retry_sec)
+        self._heap = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def push(self, when, key):
+        with self._lock:
+            heapq.heappush(self._heap, (when, key))
+            if self._heap[0] == (when, key):
+                self._wake.set()
+
+    def extend(self, items):
+        with self._lock:
+            self._heap.extend(items)
+            heapq.heapify(self._heap)
+        self._wake.set()
+
+    def pop_due(self, now):
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[1])
+        return due
+
+    def run_due(self):
+        now = datetime.now()
+        due = self.pop_due(now)
+        if due:
+            try:
+                self.on_due(due, now)
+            except Exception:
+                self.extend([(now + self.retry, key) for key in due])
+                raise
+        return len(due)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                next_due = self._heap[0][0] if self._heap else None
+            timeout = None if next_due is None else max(0.0, (next_due - datetime.now()).total_seconds())
+            self._wake.wait(timeout)
+            self._wake.clear()
+            try:
+                self.run_due()
+            except Exception as e:
+                print(f"[{self.name}] failed: {e!r}")
+
+
+class PremiumCache:
+    """Статус премиума в памяти: user_id → (is_premium, premium_until).
+
+    Чтение — поиск в словаре, без запросов к БД после первого обращения. Сроки
+    подписок лежат в одной DueHeap; в момент истечения is_premium сбрасывается
+    в users пачкой, вместо записи при каждом чтении.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.expiry = DueHeap("premium-expiry", self._expire)
+
+    def _load(self, user_id):
+        try:
+            row = fetch_one("SELECT is_premium, premium_until FROM users WHERE user_id=?", (user_id,))
+        except sqlite3.OperationalError as e:
+            if "no such column" in str(e):
+                # Если столбца нет, считаем что премиума нет
+                return False, None
+            raise
+        flag, until = row if row else (0, None)
+        entry = (bool(flag), dt_from_iso(until) if until else None)
+        with self._lock:
+            self._entries[user_id] = entry
+        if entry[0] and entry[1]:
+            self.expiry.push(entry[1], user_id)
+        return entry
+
+    def is_active(self, user_id) -> bool:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            entry = self._load(user_id)
+        flag, until = entry
+        if until:
+            return datetime.now() < until
+        return flag
 
-        # Если база старая и столбцов нет
-        if len(row) < 2:
-            return False
+    def invalidate(self, user_id, until=None):
+        """Сбрасывает запись (после оплаты); until — новый срок для кучи истечений."""
+        with self._lock:
+            self._entries.pop(user_id, None)
+        if until:
+            self.expiry.push(until, user_id)
 
-        flag, until = row[0], row[1] if len(row) > 1 else None
+    def load_expiring(self):
+        """Ставит в кучу все действующие флаги is_premium со сроком (при старте)."""
+        rows = fetch_all("SELECT user_id, premium_until FROM users "
+                         "WHERE is_premium=1 AND premium_until IS NOT NULL")
+        self.expiry.extend([(until, user_id) for user_id, until in
+                            ((uid, dt_from_iso(u)) for uid, u in rows) if until])
+
+    def _expire(self, due, now):
+        """Снимает is_premium у всех, чей срок истёк, одним UPDATE на пачку."""
+        with transaction() as c:
+            for i in range(0, len(due), 500):
+                chunk = due[i:i + 500]
+                # premium_until проверяем ещё раз: подписку могли продлить после постановки в кучу
+                c.execute(f"UPDATE users SET is_premium=0 WHERE user_id IN ({','.join('?' * len(chunk))}) "
+                          f"AND is_premium=1 AND premium_until <= ?", (*chunk, now.isoformat()))
+        with self._lock:
+            for user_id in due:
+                entry = self._entries.get(user_id)
+                if entry and entry[1] and entry[1] <= now:
+                    self._entries[user_id] = (False, entry[1])
+
+    def start(self):
+        self.load_expiring()
+        self.expiry.start()
 
-        if until:
-            active = datetime.now() < dt_from_iso(until)
-            # синхронизируем флаг
-            execute("UPDATE users SET is_premium=? WHERE user_id=?", (1 if active else 0, user_id))
-            return active
-        return bool(flag)
-    except sqlite3.OperationalError as e:
-        if "no such column" in str(e):
-            # Если столбца нет, считаем что премиума нет
-            return False
-        raise
+
+premium_cache = PremiumCache()
+
+
+def compute_is_premium(user_id) -> bool:
+    return premium_cache.is_active(user_id)
+
+
+class StateStore:
+    """Хранилище состояний FSM (мастера создания привычек и челленджей).
+
+    В памяти — OrderedDict с LRU-вытеснением (не больше max_items) и TTL у
+    каждой записи. С persist=True изменения копятся и фоновым потоком
+    пишутся в fsm_states (write-behind), а промахи памяти читаются оттуда —
+    незаконченный мастер переживает перезапуск. get() отдаёт копию: менять
+    состояние нужно через set()/update().
+    """
+
+    def __init__(self, ttl=FSM_TTL_SEC, max_items=FSM_MAX_IN_MEMORY, persist=FSM_PERSIST,
+                 flush_ms=FSM_FLUSH_MS):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.persist = persist
+        self.flush_interval = flush_ms / 1000
+        self._items = OrderedDict()  # user_id → (expires_at, data | None); None — «состояния нет»
+        self._dirty = {}             # user_id → (expires_at, data | None) к записи в БД
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def _remember(self, user_id, expires_at, data):
+        self._items[user_id] = (expires_at, data)
+        self._items.move_to_end(user_id)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def get(self, user_id, default=None):
+        now = time.time()
+        with self._lock:
+            item = self._items.get(user_id) or self._dirty.get(user_id)
+        if item is None and self.persist:
+            row = fetch_one("SELECT data, expires_at FROM fsm_states WHERE user_id=?", (user_id,))
+            item = (row[1], json_load(row[0], None)) if row else (now + self.ttl, None)
+            with self._lock:
+                self._remember(user_id, *item)
+        if item is None or item[1] is None:
+            return default
+        if item[0] <= now:
+            self.pop(user_id)
+            return default
+        with self._lock:
+            if user_id in self._items:
+                self._items.move_to_end(user_id)
+        return dict(item[1])
+
+    def set(self, user_id, data):
+        expires_at = time.time() + self.ttl
+        data = dict(data)
+        with self._lock:
+            self._remember(user_id, expires_at, data)
+            if self.persist:
+                self._dirty[user_id] = (expires_at, data)
+
+    __setitem__ = set
+
+    def update(self, user_id, **fields):
+        data = self.get(user_id, {})
+        data.update(fields)
+        self.set(user_id, data)
+        return data
+
+    def pop(self, user_id, default=None):
+        with self._lock:
+            item = self._items.pop(user_id, None)
+            if self.persist:
+                self._dirty[user_id] = (0, None)
+                self._remember(user_id, time.time() + self.ttl, None)
+        return item[1] if item and item[1] is not None else default
+
+    def flush(self):
+        """Пишет накопленные изменения одной транзакцией."""
+        if not self.persist:
+            return 0
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return 0
+            with transaction() as c:
+                c.executemany(
+                    "INSERT INTO fsm_states (user_id, data, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data=excluded.data, expires_at=excluded.expires_at",
+                    [(uid, json.dumps(data, ensure_ascii=False), exp)
+                     for uid, (exp, data) in dirty.items() if data is not None]
+                )
+                c.executemany("DELETE FROM fsm_states WHERE user_id=?",
+                              [(uid,) for uid, (_exp, data) in dirty.items() if data is None])
+            return len(dirty)
+
+    def sweep(self):
+        """Выкидывает просроченные записи из памяти и из fsm_states."""
+        now = time.time()
+        with self._lock:
+            for user_id in [uid for uid, (exp, _data) in self._items.items() if exp <= now]:
+                del self._items[user_id]
+        if self.persist:
+            execute("DELETE FROM fsm_states WHERE expires_at <= ?", (now,))
+
+    def start(self):
+        if self._thread is None and self.persist:
+            self._thread = threading.Thread(target=self._run, name="fsm-store", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        sweep_every = max(1, int(60 / self.flush_interval))
+        for tick in itertools.count(1):
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if tick % sweep_every == 0:
+                    self.sweep()
+            except Exception as e:
+                print(f"[fsm] flush failed: {e!r}")
+
+
+user_states = StateStore()
 
 
 def ensure_payments_enabled(chat_id) -> bool:
@@ -264,25 +1534,366 @@ def ensure_payments_enabled(chat_id) -> bool:
     return False
 
 
+# начисление и переход уровней — одним выражением, без цикла:
+# уровень растёт на total // LEVEL_BORDER, в карме остаётся total % LEVEL_BORDER
+_KARMA_TOTAL_SQL = "(COALESCE(karma, 0) + :credited)"
+AWARD_KARMA_SQL = f"""
+    UPDATE users SET
+        level = COALESCE(level, 1) + MAX({_KARMA_TOTAL_SQL}, 0) / {LEVEL_BORDER},
+        karma = CASE WHEN {_KARMA_TOTAL_SQL} >= 0 THEN {_KARMA_TOTAL_SQL} % {LEVEL_BORDER}
+                     ELSE {_KARMA_TOTAL_SQL} END,
+        karma_earned = karma_earned + MAX(:credited, 0)
+    WHERE user_id = :user_id
+    RETURNING level, karma"""
+KARMA_EVENT_SQL = ("INSERT INTO karma_events (user_id, amount, credited, reason, created_at) "
+                   "VALUES (?, ?, ?, ?, ?)")
+
+
+def award_karma(awards):
+    """Начисляет карму пачке (user_id, amount, reason) в одной транзакции.
+
+    Премиум-множитель берётся из premium_cache. Возвращает
+    [(user_id, amount, credited, level, karma, reason)] для найденных
+    пользователей. События пишутся в журнал karma_events той же транзакцией,
+    что и итоги в users, — журнал и итоги не расходятся даже при падении.
+    """
+    results = []
+    with transaction() as c:
+        for user_id, amount, reason in awards:
+            credited = amount * (2 if premium_cache.is_active(user_id) else 1)
+            row = c.execute(AWARD_KARMA_SQL, {"user_id": user_id, "credited": credited}).fetchone()
+            if row:
+                results.append((user_id, amount, credited, row[0], row[1], reason))
+        if results:
+            ts = now_iso()
+            c.executemany(KARMA_EVENT_SQL, [(uid, amount, credited, reason, ts)
+                                            for uid, amount, credited, _level, _karma, reason in results])
+            after_commit(lambda: _on_karma_committed(results))
+    return results
+
+class Notifier:
+    """Рассылка уведомлений о событиях через персистентную очередь notifications.
+
+    notify()/notify_select() пишут строки (event_key, user_id) в текущей
+    транзакции — уведомления появляются только вместе с самим событием, а
+    повтор события не создаёт дублей. Фоновый поток отдаёт их в Outbox
+    порциями по chunk (лимиты соблюдает Outbox) и отмечает sent_at по факту
+    отправки или окончательного отказа API (4xx: бот заблокирован и т.п.).
+    Сетевые и 5xx-ошибки оставляют уведомление в очереди — повтор через
+    poll_sec. Неотправленное после падения дошлётся при следующем старте.
+    """
+
+    def __init__(self, outbox, chunk=NOTIFY_CHUNK, poll_sec=NOTIFY_POLL_SEC, keep_days=NOTIFY_KEEP_DAYS):
+        self.outbox = outbox
+        self.chunk = chunk
+        self.poll_sec = poll_sec
+        self.keep_days = keep_days
+        self._lock = threading.Lock()
+        self._inflight = set()
+        self._done = []     # [(id, error)] — ждут записи sent_at
+        self._cursor = 0    # последний отданный в Outbox id
+        self._retry_from = None  # наименьший id с временной ошибкой — с него перечитаем…
+        self._retry_at = 0.0     # …не раньше этого момента (monotonic)
+        self._wake = threading.Event()
+        self.running = False
+
+    def notify(self, event_key, user_ids, text):
+        rows = [(event_key, uid, text, datetime.now().isoformat()) for uid in set(user_ids) if uid]
+        if not rows:
+            return
+        with transaction() as c:
+            c.executemany("INSERT OR IGNORE INTO notifications (event_key, user_id, text, created_at) "
+                          "VALUES (?, ?, ?, ?)", rows)
+            after_commit(self.kick)
+
+    def notify_select(self, event_key, text, select_user_ids, args=()):
+        """Адресаты — результат запроса (колонка user_id), без выгрузки списка в Python."""
+        with transaction() as c:
+            c.execute(f"""INSERT OR IGNORE INTO notifications (event_key, user_id, text, created_at)
+                          SELECT ?, user_id, ?, ? FROM ({select_user_ids}) WHERE user_id IS NOT NULL""",
+                      (event_key, text, datetime.now().isoformat(), *args))
+            after_commit(self.kick)
+
+    def kick(self):
+        if self.running:
+            self._wake.set()
+        else:
+            # скрипты без фоновых потоков: доставляем сразу
+            self.pump()
+
+    def _on_sent(self, notification_id):
+        def done(error):
+            with self._lock:
+                self._done.append((notification_id, error))
+            self._wake.set()
+        return done
+
+    @staticmethod
+    def _is_final(error):
+        """Доставлено или отказ, который повтор не исправит (4xx от Bot API)."""
+        return error is None or (isinstance(error, apihelper.ApiTelegramException)
+                                 and 400 <= error.error_code < 500)
+
+    def _flush_done(self):
+        with self._lock:
+            done, self._done = self._done, []
+        if not done:
+            return
+        final = [(nid, err) for nid, err in done if self._is_final(err)]
+        now = datetime.now().isoformat()
+        try:
+            with transaction() as c:
+                c.executemany("UPDATE notifications SET sent_at=?, error=? WHERE id=?",
+                              [(now, repr(err) if err else None, nid) for nid, err in final])
+        except BaseException:
+            # итоги не потеряны: запишем при следующем pump
+            with self._lock:
+                self._done[:0] = done
+            raise
+        with self._lock:
+            self._inflight.difference_update(nid for nid, _err in done)
+            for nid, err in done:
+                if not self._is_final(err):
+                    if self._retry_from is None:
+                        self._retry_at = time.monotonic() + self.poll_sec
+                    self._retry_from = min(self._retry_from or nid, nid)
+
+    def _rewind(self):
+        """Через poll_sec возвращает курсор к уведомлениям с временными ошибками — они уйдут ещё раз."""
+        with self._lock:
+            if self._retry_from is not None and time.monotonic() >= self._retry_at:
+                self._cursor = min(self._cursor, self._retry_from - 1)
+                self._retry_from = None
+
+    def pump(self):
+        """Отмечает отправленное и догружает в Outbox следующую порцию. Возвращает её размер."""
+        self._flush_done()
+        self._rewind()
+        with self._lock:
+            room = self.chunk - len(self._inflight)
+        if room <= 0:
+            return 0
+        rows = fetch_all("""SELECT id, user_id, text FROM notifications
+                            WHERE sent_at IS NULL AND id > ? ORDER BY id LIMIT ?""", (self._cursor, room))
+        for nid, user_id, text in rows:
+            self._cursor = nid
+            if self.outbox.running:
+                with self._lock:
+                    if nid in self._inflight:
+                        # после _rewind(): это уведомление ещё в Outbox
+                        continue
+                    self._inflight.add(nid)
+                self.outbox.send(user_id, text, on_sent=self._on_sent(nid))
+                continue
+            error = None
+            try:
+                self.outbox.transport(user_id, text)
+            except Exception as e:
+                error = e
+            self._on_sent(nid)(error)
+        if not self.outbox.running:
+            self._flush_done()
+        return len(rows)
+
+    def purge(self):
+        cutoff = (datetime.now() - timedelta(days=self.keep_days)).isoformat()
+        return execute("DELETE FROM notifications WHERE sent_at IS NOT NULL AND sent_at < ?", (cutoff,)).rowcount
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.purge()
+        threading.Thread(target=self._run, name="notifier", daemon=True).start()
+
+    def _run(self):
+        # kick() будит поток чаще poll_sec, поэтому чистку планируем по времени, а не по циклам
+        purge_at = time.monotonic() + NOTIFY_PURGE_SEC
+        while True:
+            self._wake.wait(self.poll_sec)
+            self._wake.clear()
+            try:
+                while self.pump():
+                    pass
+                if time.monotonic() >= purge_at:
+                    purge_at = time.monotonic() + NOTIFY_PURGE_SEC
+                    self.purge()
+            except Exception as e:
+                print(f"[notify] pump failed: {e!r}")
+
+
+notifier = Notifier(bot.outbox)
+
+
 def add_karma(user_id: int, amount: int, reason: str = ""):
-    mult = 2 if compute_is_premium(user_id) else 1
-    add = amount * mult
-    conn = db(); c = conn.cursor()
-
-    c.execute("UPDATE users SET karma = COALESCE(karma,0) + ? WHERE user_id=?", (add, user_id))
-    c.execute("SELECT karma, level FROM users WHERE user_id=?", (user_id,))
-    karma, level = c.fetchone()
-    while karma >= LEVEL_BORDER:
-        level += 1
-        karma -= LEVEL_BORDER
-    c.execute("UPDATE users SET karma=?, level=? WHERE user_id=?", (karma, level, user_id))
-    conn.commit(); conn.close()
+    award_karma([(user_id, amount, reason)])
+
+
+def _on_karma_committed(results):
+    for uid, _amount, _credited, level, karma, _reason in results:
+        leaderboard_index.update(uid, level, karma)
+
+
+def rebuild_karma_totals():
+    """Пересчитывает users.karma/level из журнала (например, после ручной правки)."""
+    totals = {uid: (total, earned) for uid, total, earned in fetch_all(
+        "SELECT user_id, SUM(credited), SUM(MAX(credited, 0)) FROM karma_events GROUP BY user_id")}
+    users = [uid for (uid,) in fetch_all("SELECT user_id FROM users")]
+    with transaction() as c:
+        c.executemany(
+            "UPDATE users SET level=?, karma=?, karma_earned=? WHERE user_id=?",
+            [(1 + max(t, 0) // LEVEL_BORDER, t % LEVEL_BORDER if t >= 0 else t, earned, uid)
+             for uid, (t, earned) in ((uid, totals.get(uid) or (0, 0)) for uid in users)]
+        )
+    leaderboard_index.reset()
+    return len(users)
+
+
+class Leaderboard:
+    """Рейтинг в памяти: отсортированный список ключей (-level, -karma, user_id).
+
+    Место пользователя ищется бинарным поиском за O(log n); при начислении кармы
+    ключ переставляется (bisect + сдвиг списка). Текст топа кэшируется и
+    сбрасывается, только когда изменение задевает первые LEADERBOARD_TOP мест;
+    версия не даёт сохранить текст, прочитанный до такого изменения.
+    """
+
+    def __init__(self, top=LEADERBOARD_TOP):
+        self.top = top
+        self._keys = None
+        self._by_user = {}
+        self._pending = None  # начисления, пришедшие во время load()
+        self._top_text = None
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Читает весь рейтинг из БД — при старте (start_background_workers), не в хэндлере."""
+        with self._lock:
+            if self._keys is not None or self._pending is not None:
+                return
+            self._pending = {}
+        try:
+            rows = fetch_all("SELECT user_id, COALESCE(level, 1), COALESCE(karma, 0) FROM users")
+        except BaseException:
+            with self._lock:
+                self._pending = None
+            raise
+        by_user = {uid: (-level, -karma, uid) for uid, level, karma in rows}
+        with self._lock:
+            # начисления за время чтения не старее прочитанного
+            by_user.update(self._pending)
+            self._pending = None
+            self._by_user = by_user
+            self._keys = sorted(by_user.values())
+            self._drop_top()
+
+    def _drop_top(self):
+        self._top_text = None
+        self._version += 1
+
+    def reset(self):
+        with self._lock:
+            self._keys = None
+            self._by_user = {}
+            self._drop_top()
+
+    def update(self, user_id, level, karma):
+        new_key = (-level, -karma, user_id)
+        with self._lock:
+            if self._keys is None:
+                if self._pending is not None:
+                    self._pending[user_id] = new_key
+                # не загружен — при загрузке прочитаем актуальные значения из БД
+                self._drop_top()
+                return
+            old_key = self._by_user.get(user_id)
+            if old_key == new_key:
+                return
+            touched = False
+            if old_key is not None:
+                pos = bisect.bisect_left(self._keys, old_key)
+                del self._keys[pos]
+                touched = pos < self.top
+            pos = bisect.bisect_left(self._keys, new_key)
+            self._keys.insert(pos, new_key)
+            self._by_user[user_id] = new_key
+            if touched or pos < self.top:
+                self._drop_top()
+
+    def invalidate_top(self):
+        with self._lock:
+            self._drop_top()
+
+    def rank(self, user_id):
+        """(место, всего) или None; у равных по уровню и карме место общее."""
+        if self._keys is None:
+            # скрипты без фоновых воркеров (bench.py и т.п.)
+            self.load()
+        with self._lock:
+            key = self._by_user.get(user_id) if self._keys is not None else None
+            if key is None:
+                return None
+            return bisect.bisect_left(self._keys, key[:2]) + 1, len(self._keys)
+
+    def top_text(self):
+        with self._lock:
+            text, version = self._top_text, self._version
+        if text is not None:
+            return text
+        rows = fetch_all("SELECT username, karma, level FROM users ORDER BY level DESC, karma DESC LIMIT ?",
+                         (self.top,))
+        if not rows:
+            return None
+        text = f"🏅 <b>Топ-{self.top}</b>\n\n"
+        for i, (username, karma, level) in enumerate(rows, 1):
+            text += f"{i}. @{username or 'user'} — {karma}✨ / lvl {level}\n"
+        with self._lock:
+            # пока читали, топ мог поменяться — такой текст не кэшируем
+            if self._version == version:
+                self._top_text = text
+        return text
+
+
+leaderboard_index = Leaderboard()
 
 def add_achievement(user_id, title, desc):
-    execute(
-        "INSERT INTO achievements (user_id, title, description, earned_date) VALUES (?, ?, ?, ?)",
-        (user_id, title, desc, now_iso())
-    )
+    with transaction() as c:
+        c.execute(
+            "INSERT INTO achievements (user_id, title, description, earned_date) VALUES (?, ?, ?, ?)",
+            (user_id, title, desc, now_iso())
+        )
+        c.execute("UPDATE users SET achievements_count = achievements_count + 1 WHERE user_id=?", (user_id,))
+
+def keyset_page(query, args, cursor, newer, limit, key="id"):
+    """Страница по ключу (keyset) вместо OFFSET: цена не растёт с номером страницы.
+
+    query содержит {cond} и {order}; cursor — граничный id (None — первая страница),
+    newer=True листает к более новым (id > cursor). Строки всегда по убыванию id.
+    Возвращает (rows, has_newer, has_older).
+    """
+    if newer:
+        cond, order = f"{key} > ?", "ASC"
+    else:
+        cond, order = f"{key} < ?", "DESC"
+        if cursor is None:
+            cursor = sys.maxsize
+    rows = fetch_all(query.format(cond=cond, order=order), (*args, cursor, limit + 1))
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if newer:
+        rows.reverse()
+        return rows, more, True
+    return rows, cursor != sys.maxsize, more
+
+def page_nav_buttons(prefix, rows, has_newer, has_older):
+    """Кнопки «◀️/▶️» для keyset-страницы; callback_data: {prefix}:p|n:{cursor}."""
+    nav = []
+    if rows and has_newer:
+        nav.append(types.InlineKeyboardButton("◀️ Назад", callback_data=f"{prefix}:p:{rows[0][0]}"))
+    if rows and has_older:
+        nav.append(types.InlineKeyboardButton("Вперёд ▶️", callback_data=f"{prefix}:n:{rows[-1][0]}"))
+    return nav
 
 def parse_referrer(start_text: str):
     if not start_text:
@@ -316,6 +1927,99 @@ def challenge_inline(chl_id, joined: bool, is_creator: bool, status: str):
         kb.add(types.InlineKeyboardButton("🔎 Итоги", callback_data=f"chl:details:{chl_id}"))
     return kb
 
+# ===================== МАРШРУТИЗАЦИЯ =====================
+
+class Router:
+    """Диспетчеризация апдейтов одним поиском в словаре вместо цепочки func-фильтров.
+
+    - texts: точный текст кнопки меню → хэндлер(message);
+    - states: состояние FSM пользователя → хэндлер(message);
+    - callbacks: точное callback_data → хэндлер(call);
+    - prefixes: "ns:action" → (хэндлер(call, arg), parse) для данных вида
+      "ns:action:arg", аргумент разбирается заранее.
+
+    Кнопки меню срабатывают раньше шагов FSM, так что меню работает и посреди
+    мастера создания. Стоимость диспетчеризации не растёт с числом хэндлеров.
+    """
+
+    def __init__(self, state_of):
+        self.state_of = state_of
+        self.texts = {}
+        self.states = {}
+        self.callbacks = {}
+        self.prefixes = {}
+
+    def _register(self, table, key, value):
+        if key in table:
+            raise ValueError(f"route already registered: {key!r}")
+        table[key] = value
+
+    def text(self, text):
+        def deco(fn):
+            self._register(self.texts, text, fn)
+            return fn
+        return deco
+
+    def state(self, state):
+        def deco(fn):
+            self._register(self.states, state, fn)
+            return fn
+        return deco
+
+    def callback(self, data):
+        def deco(fn):
+            self._register(self.callbacks, data, fn)
+            return fn
+        return deco
+
+    def callback_prefix(self, prefix, parse=int):
+        def deco(fn):
+            self._register(self.prefixes, prefix, (fn, parse))
+            return fn
+        return deco
+
+    def dispatch_message(self, message) -> bool:
+        handler = self.texts.get(message.text)
+        if handler is None:
+            handler = self.states.get(self.state_of(message.from_user.id))
+        if handler is None:
+            return False
+        note_handler(handler.__name__)
+        handler(message)
+        return True
+
+    def dispatch_callback(self, call) -> bool:
+        data = call.data or ""
+        handler = self.callbacks.get(data)
+        if handler is not None:
+            note_handler(handler.__name__)
+            handler(call)
+            return True
+        ns, _, rest = data.partition(":")
+        action, _, raw_arg = rest.partition(":")
+        route = self.prefixes.get(f"{ns}:{action}")
+        if route is None or not raw_arg:
+            return False
+        handler, parse = route
+        try:
+            arg = parse(raw_arg)
+        except ValueError:
+            return False
+        note_handler(handler.__name__)
+        handler(call, arg)
+        return True
+
+
+def parse_page(raw):
+    """'n:123' → ('n', 123): направление и курсор keyset-страницы."""
+    direction, cursor = raw.split(":")
+    if direction not in ("p", "n"):
+        raise ValueError(raw)
+    return direction, int(cursor)
+
+
+router = Router(state_of=lambda user_id: user_states.get(user_id, {}).get("state"))
+
 # ===================== СТАРТ / РЕФЕРАЛЫ =====================
 
 @bot.message_handler(commands=['start'])
@@ -326,12 +2030,11 @@ def start_cmd(message):
     if ref_id and ref_id != user_id:
         row = fetch_one("SELECT referrer_id FROM users WHERE user_id=?", (user_id,))
         if row and row[0] is None:
-            execute("UPDATE users SET referrer_id=? WHERE user_id=?", (ref_id, user_id))
-            add_karma(ref_id, REF_BONUS, reason="referral")
-            try:
-                bot.send_message(ref_id, f"🎉 По твоей ссылке пришёл новый друг! +{REF_BONUS} кармы.")
-            except Exception:
-                pass
+            with transaction():
+                execute("UPDATE users SET referrer_id=? WHERE user_id=?", (ref_id, user_id))
+                add_karma(ref_id, REF_BONUS, reason="referral")
+                notifier.notify(f"referral:{user_id}", [ref_id],
+                                f"🎉 По твоей ссылке пришёл новый друг! +{REF_BONUS} кармы.")
 
     bot.send_message(
         message.chat.id,
@@ -343,7 +2046,7 @@ def start_cmd(message):
 
 # ===================== ПРИВЫЧКИ =====================
 
-@bot.message_handler(func=lambda m: m.text == '🎯 Мои привычки')
+@router.text('🎯 Мои привычки')
 def show_habits(message):
     user_id, _ = ensure_user(message)
     rows = fetch_all("SELECT id, name, current_progress, target, is_done FROM habits WHERE user_id=?", (user_id,))
@@ -364,18 +2067,18 @@ def show_habits(message):
         text += f"{status} <b>{name}</b> — {cur}/{tgt}\n"
     bot.send_message(message.chat.id, text, reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data == "habit:add")
+@router.callback("habit:add")
 def habit_add_callback(call):
     user_states[call.from_user.id] = {"state": "habit_wait_name"}
     bot.answer_callback_query(call.id)
     bot.send_message(call.message.chat.id, "📝 Введи название новой привычки (например: «Бег по утрам»):")
 
-@bot.message_handler(func=lambda m: user_states.get(m.from_user.id, {}).get("state") == "habit_wait_name")
+@router.state("habit_wait_name")
 def habit_get_name(message):
     user_states[message.from_user.id] = {"state": "habit_wait_target", "habit_name": message.text.strip()}
     bot.send_message(message.chat.id, "🎯 Какая цель? Введи число (сколько раз):")
 
-@bot.message_handler(func=lambda m: user_states.get(m.from_user.id, {}).get("state") == "habit_wait_target")
+@router.state("habit_wait_target")
 def habit_save(message):
     user_id = message.from_user.id
     st = user_states.get(user_id, {})
@@ -385,14 +2088,16 @@ def habit_save(message):
     except Exception:
         bot.send_message(message.chat.id, "❌ Введи число для цели (например: 30).")
         return
-    execute(
-        "INSERT INTO habits (user_id, name, target, current_progress, created_date) VALUES (?, ?, ?, 0, ?)",
-        (user_id, habit_name, target, now_iso())
-    )
+    with transaction() as c:
+        c.execute(
+            "INSERT INTO habits (user_id, name, target, current_progress, created_date) VALUES (?, ?, ?, 0, ?)",
+            (user_id, habit_name, target, now_iso())
+        )
+        c.execute("UPDATE users SET habits_total = habits_total + 1 WHERE user_id=?", (user_id,))
     user_states.pop(user_id, None)
     bot.send_message(message.chat.id, f"✅ Привычка «{habit_name}» добавлена! Цель: {target}.")
 
-@bot.callback_query_handler(func=lambda c: c.data == "habit:track")
+@router.callback("habit:track")
 def habit_track_select(call):
     user_id = call.from_user.id
     rows = fetch_all("SELECT id, name FROM habits WHERE user_id=? AND is_done=0", (user_id,))
@@ -405,21 +2110,29 @@ def habit_track_select(call):
     bot.answer_callback_query(call.id)
     bot.send_message(call.message.chat.id, "Выбери привычку:", reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("habit:progress:"))
-def habit_mark_progress(call):
-    habit_id = int(call.data.split(":")[-1])
-    row = fetch_one("SELECT name, current_progress, target, user_id FROM habits WHERE id=?", (habit_id,))
+@router.callback_prefix("habit:progress")
+def habit_mark_progress(call, habit_id):
+    user_id = call.from_user.id
+    # атомарный +1 с условием «ещё не выполнена»: параллельные нажатия (в том числе
+    # в async-режиме без шардов) не теряют прогресс и не дают награду дважды
+    with transaction() as c:
+        row = c.execute(
+            "UPDATE habits SET current_progress = current_progress + 1, "
+            "is_done = current_progress + 1 >= target "
+            "WHERE id=? AND user_id=? AND is_done=0 RETURNING name, current_progress, target, is_done",
+            (habit_id, user_id)
+        ).fetchone()
+        if row and row[3]:
+            c.execute("UPDATE users SET habits_done = habits_done + 1 WHERE user_id=?", (user_id,))
+            add_achievement(user_id, "🧘 Настойчивость", f"Завершил привычку «{row[0]}».")
+            add_karma(user_id, KARMA_PER_HABIT_COMPLETE, reason="habit_complete")
     if not row:
-        bot.answer_callback_query(call.id, "Привычка не найдена.")
+        done = fetch_one("SELECT is_done FROM habits WHERE id=? AND user_id=?", (habit_id, user_id))
+        bot.answer_callback_query(call.id, "Привычка уже выполнена." if done else "Привычка не найдена.")
         return
-    name, cur, tgt, user_id = row
-    cur += 1
-    done = 1 if cur >= tgt else 0
-    execute("UPDATE habits SET current_progress=?, is_done=? WHERE id=?", (cur, done, habit_id))
+    name, cur, tgt, done = row
 
     if done:
-        add_achievement(user_id, "🧘 Настойчивость", f"Завершил привычку «{name}».")
-        add_karma(user_id, KARMA_PER_HABIT_COMPLETE, reason="habit_complete")
         bot.answer_callback_query(call.id, "🎉 Привычка выполнена!")
         bot.send_message(call.message.chat.id, f"🎉 Поздравляю! Ты выполнил привычку «{name}»!")
     else:
@@ -428,181 +2141,380 @@ def habit_mark_progress(call):
 
 # ===================== ЧЕЛЛЕНДЖИ =====================
 
+def finalize_challenges(chl_ids):
+    """Пытаемся завершить пачку челленджей (по дедлайну или если есть победители).
+
+    Все статусы, призы и уведомления (итог — участникам и создателю, приз —
+    победителям) фиксируются одной транзакцией. Возвращает список
+    (chl_id, ok, info, creator_id, winners) в порядке chl_ids.
+    """
+    results = []
+    now = datetime.now()
+    with transaction() as c:
+        for chl_id in chl_ids:
+            row = c.execute("""SELECT id, name, target_count, prize_pool, status, deadline, creator_id
+                               FROM challenges WHERE id=?""", (chl_id,)).fetchone()
+            if not row:
+                results.append((chl_id, False, "Челлендж не найден.", None, [])); continue
+            _id, name, target_count, pool, status, deadline, creator_id = row
+            if status == "finished":
+                results.append((chl_id, False, "Уже завершён.", creator_id, [])); continue
+
+            winners = [uid for (uid,) in c.execute(
+                "SELECT user_id FROM challenge_participants WHERE challenge_id=? AND progress>=?",
+                (chl_id, int(target_count))
+            )] if target_count else []
+
+            # дедлайн
+            ddl = dt_from_iso(deadline) if deadline else None
+            deadline_passed = ddl and now >= ddl
+
+            # если никто не достиг цели, но дедлайн прошёл — победителей нет
+            if not winners and not deadline_passed:
+                results.append((chl_id, False, "Условия завершения ещё не выполнены.", creator_id, []))
+                continue
+
+            # распределяем приз
+            net_pool = int(pool * (100 - COMMISSION_PCT) / 100) if pool else 0
+            per_winner = int(net_pool / max(1, len(winners))) if winners else 0
+
+            # статус меняем условно: параллельное завершение не раздаст приз дважды
+            c.execute("UPDATE challenges SET status='finished', winners=? "
+                      "WHERE id=? AND status='active'",
+                      (json.dumps(winners, ensure_ascii=False), chl_id))
+            if c.rowcount == 0:
+                results.append((chl_id, False, "Уже завершён.", creator_id, [])); continue
+            c.executemany("UPDATE users SET challenges_won = challenges_won + 1 WHERE user_id=?",
+                          [(uid,) for uid in winners])
+
+            info = f"Челлендж «{name}» завершён. Победителей: {len(winners)}. Награда каждому: {per_winner}."
+            notifier.notify_select(f"chl_finished:{chl_id}", f"🏁 {info}",
+                                   "SELECT user_id FROM challenge_participants WHERE challenge_id=? "
+                                   "UNION SELECT ?", (chl_id, creator_id))
+            if winners and per_winner > 0:
+                for uid, _amount, credited, *_rest in award_karma(
+                        [(uid, per_winner, "challenge_win") for uid in winners]):
+                    notifier.notify(f"chl_prize:{chl_id}", [uid],
+                                    f"🏆 Ты победил в «{name}»! +{credited} кармы.")
+            results.append((chl_id, True, info, creator_id, winners))
+            after_commit(public_catalog.invalidate)
+            after_commit(lambda chl_id=chl_id: challenge_cards.bump(chl_id))
+    return results
+
 def finalize_challenge(chl_id):
-    """Пытаемся завершить челлендж: по дедлайну или если есть победители"""
-    row = fetch_one("""SELECT id, name, target_count, prize_pool, participants, status, deadline
-                       FROM challenges WHERE id=?""", (chl_id,))
-    if not row:
-        return False, "Челлендж не найден."
-    _id, name, target_count, pool, participants_json, status, deadline = row
-    if status == "finished":
-        return False, "Уже завершён."
+    _id, ok, info, _creator_id, _winners = finalize_challenges([chl_id])[0]
+    return ok, info
+
 
-    participants = json_load(participants_json, {})
-    winners = [int(uid) for uid, prog in participants.items() if target_count and int(prog) >= int(target_count)]
+class ChallengeDeadlines:
+    """Авто-завершение челленджей по дедлайну.
 
-    # дедлайн
-    ddl = dt_from_iso(deadline) if deadline else None
-    deadline_passed = ddl and datetime.now() >= ddl
+    Дедлайны активных челленджей загружаются в DueHeap при старте и
+    добавляются при создании; в срок просроченные завершаются одной
+    транзакцией, итоги рассылает Notifier.
+    """
 
-    # если никто не достиг цели, но дедлайн прошёл — победителей нет
-    if not winners and not deadline_passed:
-        return False, "Условия завершения ещё не выполнены."
+    def __init__(self):
+        self.heap = DueHeap("challenge-deadlines", self._finalize_due)
 
-    # распределяем приз
-    net_pool = int(pool * (100 - COMMISSION_PCT) / 100) if pool else 0
-    per_winner = int(net_pool / max(1, len(winners))) if winners else 0
+    def schedule(self, chl_id, deadline):
+        ddl = dt_from_iso(deadline) if isinstance(deadline, str) else deadline
+        if ddl:
+            self.heap.push(ddl, chl_id)
 
-    if winners and per_winner > 0:
-        for uid in winners:
-            add_karma(uid, per_winner, reason="challenge_win")
+    def load(self):
+        rows = fetch_all("""SELECT id, deadline FROM challenges
+                            WHERE status='active' AND deadline IS NOT NULL""")
+        self.heap.extend([(ddl, chl_id) for chl_id, ddl in
+                          ((cid, dt_from_iso(d)) for cid, d in rows) if ddl])
 
-    execute("UPDATE challenges SET status='finished', winners=? WHERE id=?",
-            (json.dumps(winners, ensure_ascii=False), chl_id))
-    return True, f"Челлендж «{name}» завершён. Победителей: {len(winners)}. Награда каждому: {per_winner}."
+    def _finalize_due(self, due, now):
+        finalize_challenges(due)
 
-@bot.message_handler(func=lambda m: m.text == '🏆 Челленджи')
+    def start(self):
+        self.load()
+        self.heap.start()
+
+
+challenge_deadlines = ChallengeDeadlines()
+
+@router.text('🏆 Челленджи')
 def challenges_menu(message):
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("🎪 Публичные челленджи", callback_data="chl:public"))
     kb.add(types.InlineKeyboardButton("⚡ Создать свой (Премиум)", callback_data="chl:create"))
     bot.send_message(message.chat.id, "🏆 Выбери категорию челленджей:", reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data == "chl:public")
-def show_public_challenges(call):
-    # показываем только активные
-    rows = fetch_all("""SELECT id, name, description, prize_pool, target_count, deadline
-                        FROM challenges WHERE is_public=1 AND COALESCE(status,'active')='active'
-                        ORDER BY id DESC LIMIT 20""")
-    if not rows:
-        samples = [
-            ("💧 2 литра воды", "Пей воду каждый день 7 дней подряд", 7),
-            ("📚 15 страниц в день", "Читай по 15 страниц ежедневно неделю", 7),
-            ("🏃 5 км в день", "Бегай/ходи по 5 км ежедневно 7 дней", 7),
-        ]
+PUBLIC_CHALLENGES_SQL = """
+    SELECT id, name, description, prize_pool, target_count, deadline,
+           (SELECT COUNT(*) FROM challenge_participants WHERE challenge_id = challenges.id)
+    FROM challenges
+    WHERE is_public=1 AND status='active' AND {cond}
+    ORDER BY id {order}
+    LIMIT ?"""
+
+SAMPLE_CHALLENGES = [
+    ("💧 2 литра воды", "Пей воду каждый день 7 дней подряд", 7),
+    ("📚 15 страниц в день", "Читай по 15 страниц ежедневно неделю", 7),
+    ("🏃 5 км в день", "Бегай/ходи по 5 км ежедневно 7 дней", 7),
+]
+
+
+class PublicCatalog:
+    """Кэш отрисованных страниц публичного каталога: (cursor, newer) → (text, kb).
+
+    Создание и завершение челленджа или смена числа участников сбрасывают
+    все страницы сразу — границы keyset-страниц всё равно сдвигаются. Версия
+    защищает от гонки: страница, отрисованная до сброса, в кэш не попадёт.
+    """
+
+    def __init__(self, page_size=PUBLIC_CHALLENGES_PAGE, max_pages=CATALOG_CACHE_PAGES):
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self._pages = OrderedDict()
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def page(self, cursor=None, newer=False):
+        key = (cursor, newer)
+        with self._lock:
+            hit = self._pages.get(key)
+            if hit is not None:
+                self._pages.move_to_end(key)
+                return hit
+            version = self._version
+        page = self._render(cursor, newer)
+        with self._lock:
+            if version == self._version:
+                self._pages[key] = page
+                while len(self._pages) > self.max_pages:
+                    self._pages.popitem(last=False)
+        return page
+
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+            self._pages.clear()
+
+    def _render(self, cursor, newer):
+        rows, has_newer, has_older = keyset_page(PUBLIC_CHALLENGES_SQL, (), cursor, newer, self.page_size)
+        if not rows and cursor is not None:
+            # страница опустела (челленджи завершились) — показываем начало каталога
+            rows, has_newer, has_older = keyset_page(PUBLIC_CHALLENGES_SQL, (), None, False, self.page_size)
         kb = types.InlineKeyboardMarkup()
-        for i, (name, desc, _) in enumerate(samples):
-            kb.add(types.InlineKeyboardButton(name, callback_data=f"chl:sample_join:{i}"))
-        bot.edit_message_text("🎯 Доступные челленджи (примеры):", call.message.chat.id, call.message.message_id, reply_markup=kb)
-        return
-
-    text = "<b>Публичные челленджи:</b>\n\n"
-    kb = types.InlineKeyboardMarkup()
-    for _id, name, desc, pool, tcount, ddl in rows:
-        ddl_txt = f"до {ddl.split('T')[0]}" if ddl else "без дедлайна"
-        text += f"• <b>{name}</b> — {desc}\n   Цель: {tcount} | Приз: {pool} 💰 | {ddl_txt}\n"
-        kb.add(types.InlineKeyboardButton(f"Участвовать: {name}", callback_data=f"chl:join:{_id}"))
-        kb.add(types.InlineKeyboardButton(f"Детали: {name}", callback_data=f"chl:details:{_id}"))
+        if not rows:
+            for i, (name, _desc, _days) in enumerate(SAMPLE_CHALLENGES):
+                kb.add(types.InlineKeyboardButton(name, callback_data=f"chl:sample_join:{i}"))
+            return "🎯 Доступные челленджи (примеры):", kb
+
+        text = "<b>Публичные челленджи:</b>\n\n"
+        for _id, name, desc, pool, tcount, ddl, members in rows:
+            ddl_txt = f"до {ddl.split('T')[0]}" if ddl else "без дедлайна"
+            if desc and len(desc) > CATALOG_DESC_MAX:
+                desc = desc[:CATALOG_DESC_MAX - 1] + "…"
+            text += (f"• <b>{name}</b> — {desc}\n"
+                     f"   Цель: {tcount} | Приз: {pool} 💰 | 👥 {members} | {ddl_txt}\n")
+            kb.row(types.InlineKeyboardButton("Участвовать", callback_data=f"chl:join:{_id}"),
+                   types.InlineKeyboardButton(f"Детали: {name}", callback_data=f"chl:details:{_id}"))
+        nav = page_nav_buttons("chl:pub", rows, has_newer, has_older)
+        if nav:
+            kb.row(*nav)
+        return text, kb
+
+
+public_catalog = PublicCatalog()
+
+
+def show_catalog_page(call, text, kb):
+    bot.answer_callback_query(call.id)
     try:
         bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=kb)
     except Exception:
         bot.send_message(call.message.chat.id, text, reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("chl:details:"))
-def chl_details(call):
-    chl_id = int(call.data.split(":")[-1])
-    row = fetch_one("""SELECT id, name, description, creator_id, prize_pool, participants, is_public,
-                              COALESCE(status,'active'), target_count, deadline, winners
-                       FROM challenges WHERE id=?""", (chl_id,))
-    if not row:
+
+@router.callback("chl:public")
+def show_public_challenges(call):
+    # только активные, страницами по PUBLIC_CHALLENGES_PAGE
+    show_catalog_page(call, *public_catalog.page())
+
+
+@router.callback_prefix("chl:pub", parse=parse_page)
+def public_challenges_page(call, page):
+    direction, cursor = page
+    show_catalog_page(call, *public_catalog.page(cursor, newer=(direction == "p")))
+
+class ChallengeCards:
+    """Кэш текста карточек челленджей: chl_id → (version, text, creator_id, status).
+
+    Версия челленджа растёт при вступлении, выходе, прогрессе и завершении
+    (bump) — устаревшая карточка просто не совпадёт по версии. Кнопки
+    зависят от смотрящего (участник/создатель) и строятся на каждый запрос.
+    """
+
+    def __init__(self, max_items=CARD_CACHE_SIZE):
+        self.max_items = max_items
+        self._cards = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def bump(self, chl_id):
+        with self._lock:
+            self._versions[chl_id] = self._versions.get(chl_id, 0) + 1
+            self._cards.pop(chl_id, None)
+
+    def get(self, chl_id):
+        """(text, creator_id, status) или None, если челленджа нет."""
+        with self._lock:
+            version = self._versions.get(chl_id, 0)
+            card = self._cards.get(chl_id)
+            if card is not None and card[0] == version:
+                self._cards.move_to_end(chl_id)
+                return card[1:]
+        card = self._render(chl_id)
+        if card is None:
+            return None
+        with self._lock:
+            if self._versions.get(chl_id, 0) == version:
+                self._cards[chl_id] = (version, *card)
+                while len(self._cards) > self.max_items:
+                    evicted, _card = self._cards.popitem(last=False)
+                    # версия нужна, только пока карточка в кэше
+                    self._versions.pop(evicted, None)
+        return card
+
+    def _render(self, chl_id):
+        row = fetch_one("""SELECT name, description, creator_id, prize_pool, status, target_count, deadline, winners,
+                                  (SELECT COUNT(*) FROM challenge_participants WHERE challenge_id=challenges.id),
+                                  (SELECT MAX(progress) FROM challenge_participants WHERE challenge_id=challenges.id)
+                           FROM challenges WHERE id=?""", (chl_id,))
+        if not row:
+            return None
+        name, desc, creator_id, pool, status, tcount, deadline, winners_json, participants_count, best = row
+        ddl_txt = deadline.split('T')[0] if deadline else "—"
+        text = (f"<b>{name}</b>\n"
+                f"{desc}\n\n"
+                f"Статус: <b>{status}</b>\n"
+                f"Цель: <b>{tcount}</b>\n"
+                f"Дедлайн: <b>{ddl_txt}</b>\n"
+                f"Призовой фонд: <b>{pool}</b> (комиссия {COMMISSION_PCT}%)\n"
+                f"Участников: <b>{participants_count}</b>\n"
+                f"Лучший прогресс: <b>{best or 0}</b>\n")
+        if status == "finished":
+            winners = json_load(winners_json, [])
+            names = user_cache.get_many(winners)
+            text += f"\nПобедители: {', '.join('@' + (names[w] or 'user') for w in winners) if winners else '—'}"
+        return text, creator_id, status
+
+
+challenge_cards = ChallengeCards()
+
+
+@router.callback_prefix("chl:details")
+def chl_details(call, chl_id):
+    card = challenge_cards.get(chl_id)
+    if card is None:
         bot.answer_callback_query(call.id, "Челлендж не найден."); return
-    _id, name, desc, creator_id, pool, participants_json, is_public, status, tcount, deadline, winners_json = row
-    participants = json_load(participants_json, {})
-    winners = json_load(winners_json, [])
+    text, creator_id, status = card
     user_id = call.from_user.id
-    joined = str(user_id) in participants
-    is_creator = (user_id == creator_id)
-    ddl_txt = deadline.split('T')[0] if deadline else "—"
-
-    text = (f"<b>{name}</b>\n"
-            f"{desc}\n\n"
-            f"Статус: <b>{status}</b>\n"
-            f"Цель: <b>{tcount}</b>\n"
-            f"Дедлайн: <b>{ddl_txt}</b>\n"
-            f"Призовой фонд: <b>{pool}</b> (комиссия {COMMISSION_PCT}%)\n"
-            f"Участников: <b>{len(participants)}</b>\n")
-    if status == "finished":
-        text += f"\nПобедители: {', '.join('@'+fetch_one('SELECT username FROM users WHERE user_id=?',(w,))[0] or 'user' for w in winners) if winners else '—'}"
-
+    # кнопки — под конкретного пользователя; у завершённого участие не важно
+    joined = status != "finished" and fetch_one(
+        "SELECT 1 FROM challenge_participants WHERE challenge_id=? AND user_id=?", (chl_id, user_id)) is not None
     bot.answer_callback_query(call.id)
-    bot.send_message(call.message.chat.id, text, reply_markup=challenge_inline(chl_id, joined, is_creator, status))
+    bot.send_message(call.message.chat.id, text,
+                     reply_markup=challenge_inline(chl_id, joined, user_id == creator_id, status))
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("chl:sample_join:"))
-def sample_join(call):
+@router.callback_prefix("chl:sample_join")
+def sample_join(call, _sample):
     add_karma(call.from_user.id, KARMA_FOR_PUBLIC_JOIN, reason="join_sample")
     bot.answer_callback_query(call.id, "🎉 Ты присоединился! +10 кармы")
     bot.send_message(call.message.chat.id, "✅ Участие подтверждено. Проверь прогресс в статистике!")
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("chl:join:"))
-def join_real_challenge(call):
+@router.callback_prefix("chl:join")
+def join_real_challenge(call, chl_id):
     user_id = call.from_user.id
-    chl_id = int(call.data.split(":")[-1])
-    row = fetch_one("SELECT participants, COALESCE(status,'active') FROM challenges WHERE id=?", (chl_id,))
+    row = fetch_one("SELECT status, is_public FROM challenges WHERE id=?", (chl_id,))
     if not row:
         bot.answer_callback_query(call.id, "Челлендж не найден."); return
-    participants = json_load(row[0], {})
-    status = row[1]
+    status, is_public = row
     if status != "active":
         bot.answer_callback_query(call.id, "Челлендж уже завершён."); return
-    if str(user_id) in participants:
+    with transaction() as c:
+        joined = c.execute(
+            "INSERT OR IGNORE INTO challenge_participants (challenge_id, user_id, progress, joined_at) "
+            "VALUES (?, ?, 0, ?)", (chl_id, user_id, now_iso())
+        ).rowcount
+        if joined:
+            c.execute("UPDATE users SET challenges_joined = challenges_joined + 1 WHERE user_id=?", (user_id,))
+    if not joined:
         bot.answer_callback_query(call.id, "Ты уже участвуешь."); return
-    participants[str(user_id)] = 0
-    execute("UPDATE challenges SET participants=? WHERE id=?", (json.dumps(participants, ensure_ascii=False), chl_id))
+    challenge_cards.bump(chl_id)
+    if is_public:
+        public_catalog.invalidate()
     add_karma(user_id, KARMA_FOR_PUBLIC_JOIN, reason="join_public")
     bot.answer_callback_query(call.id, "🎉 Ты в деле! +10 кармы")
     bot.send_message(call.message.chat.id, "✅ Участие подтверждено. Открывай детали челленджа и жми «Прогресс +1».")
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("chl:leave:"))
-def chl_leave(call):
+@router.callback_prefix("chl:leave")
+def chl_leave(call, chl_id):
     user_id = call.from_user.id
-    chl_id = int(call.data.split(":")[-1])
-    row = fetch_one("SELECT participants, COALESCE(status,'active') FROM challenges WHERE id=?", (chl_id,))
+    row = fetch_one("SELECT status, is_public FROM challenges WHERE id=?", (chl_id,))
     if not row:
         bot.answer_callback_query(call.id, "Челлендж не найден."); return
-    participants = json_load(row[0], {})
-    status = row[1]
+    status, is_public = row
     if status != "active":
         bot.answer_callback_query(call.id, "Челлендж завершён."); return
-    if str(user_id) not in participants:
+    with transaction() as c:
+        left = c.execute("DELETE FROM challenge_participants WHERE challenge_id=? AND user_id=?",
+                         (chl_id, user_id)).rowcount
+        if left:
+            c.execute("UPDATE users SET challenges_joined = challenges_joined - 1 WHERE user_id=?", (user_id,))
+    if not left:
         bot.answer_callback_query(call.id, "Ты не участник."); return
-    participants.pop(str(user_id), None)
-    execute("UPDATE challenges SET participants=? WHERE id=?", (json.dumps(participants, ensure_ascii=False), chl_id))
+    challenge_cards.bump(chl_id)
+    if is_public:
+        public_catalog.invalidate()
     bot.answer_callback_query(call.id, "Готово.")
     bot.send_message(call.message.chat.id, "🚪 Ты вышел из челленджа.")
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("chl:prog_inc:"))
-def chl_progress_inc(call):
+@router.callback_prefix("chl:prog_inc")
+def chl_progress_inc(call, chl_id):
     user_id = call.from_user.id
-    chl_id = int(call.data.split(":")[-1])
-    row = fetch_one("""SELECT participants, target_count, COALESCE(status,'active')
+    row = fetch_one("""SELECT target_count, status
                        FROM challenges WHERE id=?""", (chl_id,))
     if not row:
         bot.answer_callback_query(call.id, "Челлендж не найден."); return
-    participants = json_load(row[0], {})
-    tcount = int(row[1] or 0)
-    status = row[2]
+    tcount = int(row[0] or 0)
+    status = row[1]
     if status != "active":
         bot.answer_callback_query(call.id, "Челлендж завершён."); return
-    if str(user_id) not in participants:
-        bot.answer_callback_query(call.id, "Сначала вступи."); return
 
-    participants[str(user_id)] = int(participants[str(user_id)]) + 1
-    execute("UPDATE challenges SET participants=? WHERE id=?", (json.dumps(participants, ensure_ascii=False), chl_id))
+    # атомарный +1 одной строки: параллельные нажатия не теряют обновления
+    with transaction() as c:
+        progress = c.execute(
+            "UPDATE challenge_participants SET progress = progress + 1 "
+            "WHERE challenge_id=? AND user_id=? RETURNING progress",
+            (chl_id, user_id)
+        ).fetchone()
+        if progress:
+            after_commit(lambda: challenge_cards.bump(chl_id))
+    if not progress:
+        bot.answer_callback_query(call.id, "Сначала вступи."); return
+    progress = progress[0]
 
     # авто-проверка завершения
-    done = int(participants[str(user_id)]) >= tcount if tcount else False
-    msg = f"👍 Прогресс: {participants[str(user_id)]}/{tcount}" if tcount else f"👍 Прогресс: {participants[str(user_id)]}"
+    done = progress >= tcount if tcount else False
+    msg = f"👍 Прогресс: {progress}/{tcount}" if tcount else f"👍 Прогресс: {progress}"
     bot.answer_callback_query(call.id, msg)
 
     # Если кто-то достиг цели — завершаем и распределяем приз
+    # итог придёт уведомлением всем участникам, включая нажавшего
     if done:
-        ok, info = finalize_challenge(chl_id)
-        bot.send_message(call.message.chat.id, f"🏁 {info}")
+        finalize_challenge(chl_id)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("chl:finish:"))
-def chl_finish(call):
+@router.callback_prefix("chl:finish")
+def chl_finish(call, chl_id):
     user_id = call.from_user.id
-    chl_id = int(call.data.split(":")[-1])
     row = fetch_one("SELECT creator_id FROM challenges WHERE id=?", (chl_id,))
     if not row:
         bot.answer_callback_query(call.id, "Челлендж не найден."); return
@@ -610,36 +2522,62 @@ def chl_finish(call):
         bot.answer_callback_query(call.id, "Только создатель может завершить."); return
     ok, info = finalize_challenge(chl_id)
     bot.answer_callback_query(call.id, "Готово." if ok else "Не удалось.")
-    bot.send_message(call.message.chat.id, f"🏁 {info}")
+    if not ok:
+        bot.send_message(call.message.chat.id, f"🏁 {info}")
+
+MY_CHALLENGES_SQL = """
+    SELECT c.id, c.name, c.creator_id, c.status, cp.progress
+    FROM challenges c
+    LEFT JOIN challenge_participants cp ON cp.challenge_id = c.id AND cp.user_id = ?
+    WHERE c.id IN (SELECT challenge_id FROM challenge_participants WHERE user_id = ?
+                   UNION ALL
+                   SELECT id FROM challenges WHERE creator_id = ?)
+      AND {cond}
+    ORDER BY c.id {order}
+    LIMIT ?"""
+
+def render_my_challenges(user_id, cursor=None, newer=False):
+    rows, has_newer, has_older = keyset_page(
+        MY_CHALLENGES_SQL, (user_id, user_id, user_id), cursor, newer, MY_CHALLENGES_PAGE, key="c.id"
+    )
+    if not rows:
+        return None, None
 
-@bot.message_handler(func=lambda m: m.text == '🧩 Мои челленджи')
+    text = "<b>Мои челленджи</b>:\n\n"
+    kb = types.InlineKeyboardMarkup()
+    for _id, name, creator_id, status, prog in rows:
+        role = "создатель" if user_id == creator_id else "участник"
+        text += f"• <b>{name}</b> — {role}, статус: {status}, мой прогресс: {prog or 0}\n"
+        kb.add(types.InlineKeyboardButton(f"🔎 {name}", callback_data=f"chl:details:{_id}"))
+    nav = page_nav_buttons("chl:my", rows, has_newer, has_older)
+    if nav:
+        kb.row(*nav)
+    return text, kb
+
+@router.text('🧩 Мои челленджи')
 def my_challenges(message):
     user_id, _ = ensure_user(message)
-    rows = fetch_all("""SELECT id, name, participants, creator_id, COALESCE(status,'active')
-                        FROM challenges ORDER BY id DESC""")
-    mine = []
-    for _id, name, participants_json, creator_id, status in rows:
-        participants = json_load(participants_json, {})
-        if str(user_id) in participants or user_id == creator_id:
-            mine.append((_id, name, participants, creator_id, status))
-
-    if not mine:
+    text, kb = render_my_challenges(user_id)
+    if not text:
         bot.send_message(message.chat.id, "У тебя пока нет челленджей.")
         return
+    bot.send_message(message.chat.id, text, reply_markup=kb)
 
-    text = "<b>Мои челленджи</b>:\n\n"
-    for _id, name, participants, creator_id, status in mine:
-        prog = participants.get(str(user_id), 0)
-        role = "создатель" if user_id == creator_id else "участник"
-        text += f"• <b>{name}</b> — {role}, статус: {status}, мой прогресс: {prog}\n"
-        kb = challenge_inline(_id, str(user_id) in participants, user_id == creator_id, status)
-        bot.send_message(message.chat.id, text.splitlines()[-1], reply_markup=kb)
-    # отправим общий заголовок
-    bot.send_message(message.chat.id, "\n".join(text.splitlines()[:2]))
+@router.callback_prefix("chl:my", parse=parse_page)
+def my_challenges_page(call, page):
+    direction, cursor = page
+    text, kb = render_my_challenges(call.from_user.id, cursor, newer=(direction == "p"))
+    bot.answer_callback_query(call.id)
+    if not text:
+        return
+    try:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=kb)
+    except Exception:
+        bot.send_message(call.message.chat.id, text, reply_markup=kb)
 
 # === Создание челленджа (премиум) ===
 
-@bot.callback_query_handler(func=lambda c: c.data == "chl:create")
+@router.callback("chl:create")
 def create_challenge_start(call):
     user_id = call.from_user.id
     if not compute_is_premium(user_id):
@@ -651,66 +2589,58 @@ def create_challenge_start(call):
     bot.answer_callback_query(call.id)
     bot.send_message(call.message.chat.id, "Придумай название челленджа:")
 
-@bot.message_handler(func=lambda m: user_states.get(m.from_user.id, {}).get("state") == "chl_name")
+@router.state("chl_name")
 def chl_set_name(message):
-    st = user_states.setdefault(message.from_user.id, {})
-    st["name"] = message.text.strip()
-    st["state"] = "chl_desc"
+    user_states.update(message.from_user.id, name=message.text.strip(), state="chl_desc")
     bot.send_message(message.chat.id, "Добавь описание челленджа:")
 
-@bot.message_handler(func=lambda m: user_states.get(m.from_user.id, {}).get("state") == "chl_desc")
+@router.state("chl_desc")
 def chl_set_desc(message):
-    st = user_states.setdefault(message.from_user.id, {})
-    st["description"] = message.text.strip()
-    st["state"] = "chl_target_count"
+    user_states.update(message.from_user.id, description=message.text.strip(), state="chl_target_count")
     bot.send_message(message.chat.id, "Укажи числовую цель (например: 7):")
 
-@bot.message_handler(func=lambda m: user_states.get(m.from_user.id, {}).get("state") == "chl_target_count")
+@router.state("chl_target_count")
 def chl_set_target_count(message):
-    st = user_states.setdefault(message.from_user.id, {})
     try:
-        st["target_count"] = int(re.findall(r"\d+", message.text)[0])
+        target_count = int(re.findall(r"\d+", message.text)[0])
     except Exception:
         bot.send_message(message.chat.id, "Нужно число. Попробуй ещё раз.")
         return
-    st["state"] = "chl_deadline_days"
+    user_states.update(message.from_user.id, target_count=target_count, state="chl_deadline_days")
     bot.send_message(message.chat.id, "Через сколько дней дедлайн? (например: 7). 0 — без дедлайна:")
 
-@bot.message_handler(func=lambda m: user_states.get(m.from_user.id, {}).get("state") == "chl_deadline_days")
+@router.state("chl_deadline_days")
 def chl_set_deadline(message):
-    st = user_states.setdefault(message.from_user.id, {})
     try:
         days = int(re.findall(r"\d+", message.text)[0])
     except Exception:
         bot.send_message(message.chat.id, "Нужно число (0 или больше)."); return
-    st["deadline"] = (datetime.now() + timedelta(days=days)).isoformat() if days > 0 else None
-    st["state"] = "chl_pool"
+    deadline = (datetime.now() + timedelta(days=days)).isoformat() if days > 0 else None
+    user_states.update(message.from_user.id, deadline=deadline, state="chl_pool")
     bot.send_message(message.chat.id, "Размер призового фонда? Введи число (виртуальные монеты/баллы):")
 
-@bot.message_handler(func=lambda m: user_states.get(m.from_user.id, {}).get("state") == "chl_pool")
+@router.state("chl_pool")
 def chl_set_pool(message):
     user_id = message.from_user.id
-    st = user_states.setdefault(user_id, {})
     try:
         pool = int(re.findall(r"\d+", message.text)[0])
     except Exception:
         bot.send_message(message.chat.id, "Нужно число. Попробуй ещё раз.")
         return
-    st["prize_pool"] = max(0, pool)
-    st["state"] = "chl_public"
+    user_states.update(user_id, prize_pool=max(0, pool), state="chl_public")
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("Сделать публичным", callback_data="chl:finalize:public"))
     kb.add(types.InlineKeyboardButton("Сделать приватным", callback_data="chl:finalize:private"))
     bot.send_message(message.chat.id, "Публичный или приватный челлендж?", reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("chl:finalize:"))
-def chl_finalize(call):
+@router.callback_prefix("chl:finalize", parse=str)
+def chl_finalize(call, visibility):
     user_id = call.from_user.id
     st = user_states.get(user_id, {})
     if not st:
         bot.answer_callback_query(call.id, "Сессия создания потеряна. Начни заново."); return
-    is_public = 1 if call.data.endswith("public") else 0
-    execute(
+    is_public = 1 if visibility == "public" else 0
+    cur = execute(
         "INSERT INTO challenges (name, description, creator_id, target, prize_pool, participants, is_premium, "
         "is_public, created_at, status, target_count, deadline, winners) "
         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
@@ -720,7 +2650,7 @@ def chl_finalize(call):
             user_id,
             f"{st.get('target_count')} раз(а)",  # legacy текстовая цель
             st.get("prize_pool", 0),
-            json.dumps({}, ensure_ascii=False),
+            None,  # участники — в challenge_participants
             1,
             is_public,
             now_iso(),
@@ -730,35 +2660,41 @@ def chl_finalize(call):
             json.dumps([], ensure_ascii=False)
         )
     )
+    challenge_deadlines.schedule(cur.lastrowid, st.get("deadline"))
+    if is_public:
+        public_catalog.invalidate()
     user_states.pop(user_id, None)
     bot.answer_callback_query(call.id, "Создано!")
     bot.send_message(call.message.chat.id, "✅ Челлендж создан! Участники могут присоединиться в «Публичные челленджи».")
 
 # ===================== СТАТИСТИКА / АЧИВКИ / ЛИДЕРЫ =====================
 
-@bot.message_handler(func=lambda m: m.text == '📊 Статистика')
+@router.text('📊 Статистика')
 def stats(message):
     user_id, _ = ensure_user(message)
-    row = fetch_one("SELECT karma, level, is_premium, premium_until FROM users WHERE user_id=?", (user_id,))
-    row2 = fetch_one("SELECT COUNT(*) FROM habits WHERE user_id=?", (user_id,))
-    karma, level, prem_flag, prem_until = row or (0, 1, 0, None)
-    # актуализируем премиум
+    # всё — одна строка users: счётчики ведут пути записи (см. _m008_user_counters)
+    row = fetch_one("""SELECT karma, level, premium_until, karma_earned, habits_total, habits_done,
+                              achievements_count, challenges_joined, challenges_won
+                       FROM users WHERE user_id=?""", (user_id,))
+    karma, level, prem_until, earned, habits, habits_done, achievements, joined, won = \
+        row or (0, 1, None, 0, 0, 0, 0, 0, 0)
     prem_active = compute_is_premium(user_id)
     lvl_progress = "🟢" * min(level, 10) + "⚪" * max(0, 10 - min(level, 10))
     pm = "Да" if prem_active else "Нет"
     pm_until = dt_from_iso(prem_until).strftime("%Y-%m-%d") if prem_until else "—"
-    habits = row2[0] if row2 else 0
     bot.send_message(
         message.chat.id,
         f"📊 <b>Статистика</b>\n\n"
-        f"✨ Карма: <b>{karma}</b>\n"
+        f"✨ Карма: <b>{karma}</b> (всего заработано: {earned})\n"
         f"🎯 Уровень: <b>{level}</b>\n"
         f"🌟 Премиум: <b>{pm}</b> (до: {pm_until})\n"
-        f"📈 Привычек: <b>{habits}</b>\n\n"
+        f"📈 Привычек: <b>{habits}</b> (выполнено: {habits_done})\n"
+        f"🎖 Ачивок: <b>{achievements}</b>\n"
+        f"🧩 Челленджей: <b>{joined}</b> (побед: {won})\n\n"
         f"Прогресс уровней:\n{lvl_progress}"
     )
 
-@bot.message_handler(func=lambda m: m.text == '🎖 Ачивки')
+@router.text('🎖 Ачивки')
 def achivs(message):
     rows = fetch_all("SELECT title, description FROM achievements WHERE user_id=?", (message.from_user.id,))
     if not rows:
@@ -770,39 +2706,60 @@ def achivs(message):
     bot.send_message(message.chat.id, text)
 
 @bot.message_handler(commands=['leaderboard', 'top'])
-@bot.message_handler(func=lambda m: m.text == '🏅 Лидеры')
+@router.text('🏅 Лидеры')
 def leaderboard(message):
-    rows = fetch_all("SELECT username, karma, level FROM users ORDER BY level DESC, karma DESC LIMIT 10")
-    if not rows:
+    text = leaderboard_index.top_text()
+    if not text:
         bot.send_message(message.chat.id, "Таблица лидеров пока пуста."); return
-    text = "🏅 <b>Топ-10</b>\n\n"
-    for i, (username, karma, level) in enumerate(rows, 1):
-        text += f"{i}. @{username or 'user'} — {karma}✨ / lvl {level}\n"
+    place = leaderboard_index.rank(message.from_user.id)
+    if place:
+        text += f"\nТвоё место: <b>#{place[0]}</b> из {place[1]}"
     bot.send_message(message.chat.id, text)
 
 # ===================== ЕЖЕДНЕВНАЯ НАГРАДА =====================
 
-@bot.message_handler(func=lambda m: m.text == '🎁 Ежедневная награда')
+# проверка окна в 24 ч и запись отметки — одним условным UPDATE: двойное
+# нажатие или параллельный апдейт не получат награду дважды
+CLAIM_DAILY_SQL = """
+    UPDATE users SET
+        daily_streak = CASE WHEN last_daily_claim >= :streak_since THEN daily_streak + 1 ELSE 1 END,
+        last_daily_claim = :now
+    WHERE user_id = :user_id AND (last_daily_claim IS NULL OR last_daily_claim <= :claim_before)
+    RETURNING daily_streak"""
+
+
+@router.text('🎁 Ежедневная награда')
 def daily_reward(message):
     user_id, _ = ensure_user(message)
-    row = fetch_one("SELECT last_daily_claim FROM users WHERE user_id=?", (user_id,))
-    last = dt_from_iso(row[0]) if row and row[0] else None
-
     now = datetime.now()
-    if last and now - last < timedelta(hours=24):
-        left = timedelta(hours=24) - (now - last)
-        hours = int(left.total_seconds() // 3600)
-        bot.send_message(message.chat.id, f"⏰ Уже получал сегодня! Возвращайся через ~{hours} ч.")
-        return
+    with transaction() as c:
+        row = c.execute(CLAIM_DAILY_SQL, {
+            "user_id": user_id,
+            "now": now.isoformat(),
+            "claim_before": (now - timedelta(hours=24)).isoformat(),
+            "streak_since": (now - timedelta(hours=DAILY_STREAK_HOURS)).isoformat(),
+        }).fetchone()
+        if row:
+            streak = row[0]
+            bonus_pct = DAILY_STREAK_STEP_PCT * (min(streak, DAILY_STREAK_MAX_DAYS) - 1)
+            reward = random.randint(DAILY_MIN, DAILY_MAX) * (100 + bonus_pct) // 100
+            add_karma(user_id, reward, reason="daily")
 
-    reward = random.randint(DAILY_MIN, DAILY_MAX)
-    add_karma(user_id, reward, reason="daily")
-    execute("UPDATE users SET last_daily_claim=? WHERE user_id=?", (now_iso(), user_id))
-    bot.send_message(message.chat.id, f"🎉 Ты получил <b>{reward}</b> кармы за ежедневный вход!")
+    if not row:
+        # только на отказе читаем, сколько осталось ждать
+        row = fetch_one("SELECT last_daily_claim FROM users WHERE user_id=?", (user_id,))
+        last = dt_from_iso(row[0]) if row and row[0] else now
+        hours = int((timedelta(hours=24) - (now - last)).total_seconds() // 3600)
+        bot.send_message(message.chat.id, f"⏰ Уже получал сегодня! Возвращайся через ~{max(hours, 0)} ч.")
+        return
+    text = f"🎉 Ты получил <b>{reward}</b> кармы за ежедневный вход!"
+    if streak > 1:
+        text += f"\n🔥 Серия: <b>{streak}</b> дн. подряд (+{bonus_pct}% к награде)"
+    bot.send_message(message.chat.id, text)
 
 # ===================== РЕФЕРАЛЫ =====================
 
-@bot.message_handler(func=lambda m: m.text == '👥 Пригласить друга')
+@router.text('👥 Пригласить друга')
 def invite_friend(message):
     link = f"https://t.me/{bot.get_me().username}?start=ref{message.from_user.id}"
     kb = types.InlineKeyboardMarkup()
@@ -816,7 +2773,7 @@ def invite_friend(message):
 
 # ===================== МАГАЗИН / ПЛАТЕЖИ =====================
 
-@bot.message_handler(func=lambda m: m.text == '🛒 Магазин')
+@router.text('🛒 Магазин')
 @bot.message_handler(commands=['shop'])
 def open_shop(message):
     if not ensure_payments_enabled(message.chat.id):
@@ -826,7 +2783,7 @@ def open_shop(message):
     kb.add(types.InlineKeyboardButton("💰 +100 кармы — 99 ₽", callback_data='shop:buy_karma'))
     bot.send_message(message.chat.id, "🛒 Магазин улучшений:", reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data == "shop:buy_premium")
+@router.callback("shop:buy_premium")
 def shop_buy_premium(call):
     prices = [types.LabeledPrice(label='🌟 Премиум-доступ на 30 дней', amount=19900)]
     bot.answer_callback_query(call.id)
@@ -843,7 +2800,7 @@ def shop_buy_premium(call):
         invoice_payload='premium_payment'
     )
 
-@bot.callback_query_handler(func=lambda c: c.data == "shop:buy_karma")
+@router.callback("shop:buy_karma")
 def shop_buy_karma(call):
     prices = [types.LabeledPrice(label='💰 +100 кармы', amount=9900)]
     bot.answer_callback_query(call.id)
@@ -892,8 +2849,9 @@ def got_payment(message):
     )
 
     if payload == "premium_payment":
-        until = (datetime.now() + timedelta(days=30)).isoformat()
-        execute("UPDATE users SET is_premium=1, premium_until=? WHERE user_id=?", (until, user_id))
+        until = datetime.now() + timedelta(days=30)
+        execute("UPDATE users SET is_premium=1, premium_until=? WHERE user_id=?", (until.isoformat(), user_id))
+        premium_cache.invalidate(user_id, until)
         bot.send_message(
             message.chat.id,
             "✅ Оплата прошла успешно!\n"
@@ -928,25 +2886,288 @@ def help_cmd(message):
 
 @bot.message_handler(content_types=['text'])
 def fallback(message):
+    # все текстовые кнопки и шаги FSM — через router (один поиск в словаре)
+    if router.dispatch_message(message):
+        return
     if message.text.startswith("/start"):
         return
+    metrics.inc("trackbot_unhandled_updates_total", (("kind", "message"),))
     bot.send_message(message.chat.id, "Не понял команду 🤔\nВыбери действие из меню.", reply_markup=main_menu())
 
 # ===================== ЗАПУСК =====================
 
 @bot.callback_query_handler(func=lambda call: True)
 def fallback_callback(call):
+    if router.dispatch_callback(call):
+        return
     # если какой-то callback не поймали более специфичные хэндлеры — хотя бы ответим,
     # и увидим, что именно пришло
     try:
         bot.answer_callback_query(call.id, cache_time=1)
     except Exception:
         pass
+    metrics.inc("trackbot_unhandled_updates_total", (("kind", "callback"),))
     print(f"[DEBUG] callback_query: from={call.from_user.id} data={call.data!r}")
 
 
 
+def start_background_workers():
+    leaderboard_index.load()
+    premium_cache.start()
+    challenge_deadlines.start()
+    user_states.start()
+    bot.outbox.start()
+    notifier.start()
+
+
+def start_metrics_server():
+    # связываем сразу: в async-режиме глобальное имя bot указывает на AsyncBotBridge
+    dispatcher, outbox = bot.dispatcher, bot.outbox
+    metrics.add_gauges("trackbot_dispatch_queue_depth", "Апдейтов в очереди шарда",
+                       lambda: [((("shard", st["shard"]),), st["depth"]) for st in dispatcher.stats()])
+    metrics.add_gauges("trackbot_outbox", "Состояние очереди исходящих (счётчики и глубина)",
+                       lambda: [((("stat", k),), v) for k, v in outbox.stats().items()])
+    if METRICS_PORT:
+        MetricsServer(METRICS_HOST, METRICS_PORT).start()
+        print(f"Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+
+def start_profiler(directory=None):
+    global profiler
+    directory = directory or PROFILE_DIR
+    if not directory:
+        return None
+    profiler = SlowUpdateProfiler(directory, PROFILE_SLOW_UPDATE_MS, PROFILE_SLOW_SQL_MS, PROFILE_MODE)
+    profiler.start()
+    print(f"Профилирование медленных апдейтов ({PROFILE_MODE}): {directory}")
+    return profiler
+
+
+def start_update_dispatcher():
+    bot.dispatcher.start()
+    if DISPATCH_STATS_EVERY:
+        threading.Thread(target=bot.dispatcher.log_stats_forever, args=(DISPATCH_STATS_EVERY,),
+                         name="dispatch-stats", daemon=True).start()
+
+
+# ===================== ASYNCIO-РЕЖИМ =====================
+
+class AsyncBotBridge:
+    """Подменяет глобальный bot в asyncio-режиме.
+
+    Синхронные хэндлеры выполняются в пуле потоков и зовут bot.* как раньше,
+    а вызовы уходят корутинами AsyncTeleBot в event loop. Отправки без нужного
+    результата (FIRE_AND_FORGET) не ждут сеть — хэндлер сразу освобождает поток.
+    send_message, как и в синхронном режиме, идёт через Outbox с его лимитами.
+    """
+
+    FIRE_AND_FORGET = {"send_message", "answer_callback_query", "send_invoice", "answer_pre_checkout_query"}
+
+    def __init__(self, async_bot, loop, outbox=None):
+        self._async_bot = async_bot
+        self._loop = loop
+        self._outbox = outbox
+
+    def send_message(self, chat_id, text, **kwargs):
+        if self._outbox is not None and self._outbox.running:
+            return self._outbox.send(chat_id, text, **kwargs)
+        return self.__getattr__("send_message")(chat_id, text, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self._async_bot, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            fut = asyncio.run_coroutine_threadsafe(attr(*args, **kwargs), self._loop)
+            if name in self.FIRE_AND_FORGET:
+                fut.add_done_callback(_log_async_failure)
+                return fut
+            return fut.result()
+        return call
+
+
+def _log_async_failure(fut):
+    if not fut.cancelled() and fut.exception() is not None:
+        print(f"[async] API call failed: {fut.exception()!r}")
+
+
+def _to_async_handlers(sync_handlers, executor):
+    """Оборачивает синхронные хэндлеры TeleBot в корутины, работающие в executor."""
+
+    def wrap(fn):
+        async def handler(update_obj):
+            await asyncio.get_running_loop().run_in_executor(executor, fn, update_obj)
+        handler.__name__ = fn.__name__
+        return handler
+
+    return [dict(h, function=wrap(h['function'])) for h in sync_handlers]
+
+
+async def run_async():
+    """Те же хэндлеры на AsyncTeleBot; БД — в ограниченном пуле потоков."""
+    global bot
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+
+    sync_bot = bot
+    async_bot = AsyncTeleBot(BOT_TOKEN, parse_mode="HTML")
+    executor = ThreadPoolExecutor(max_workers=ASYNC_DB_WORKERS, thread_name_prefix="db")
+    for h in _to_async_handlers(sync_bot.message_handlers, executor):
+        async_bot.add_message_handler(h)
+    for h in _to_async_handlers(sync_bot.callback_query_handlers, executor):
+        async_bot.add_callback_query_handler(h)
+    for h in _to_async_handlers(sync_bot.pre_checkout_query_handlers, executor):
+        async_bot.add_pre_checkout_query_handler(h)
+
+    loop = asyncio.get_running_loop()
+
+    def send_via_loop(chat_id, text, **kw):
+        try:
+            return asyncio.run_coroutine_threadsafe(async_bot.send_message(chat_id, text, **kw), loop).result()
+        except asyncio_helper.ApiTelegramException as e:
+            # у async-клиента свой класс ошибки; Outbox разбирает 429 по синхронному
+            raise apihelper.ApiTelegramException(e.function_name, e.result, e.result_json) from e
+
+    sync_bot.outbox.transport = send_via_loop
+    bot = AsyncBotBridge(async_bot, loop, outbox=sync_bot.outbox)
+    try:
+        await async_bot.infinity_polling(timeout=60, allowed_updates=ALLOWED_UPDATES)
+    finally:
+        bot = sync_bot
+        executor.shutdown(wait=False)
+        await async_bot.close_session()
+
+
+# ===================== WEBHOOK =====================
+
+class WebhookServer:
+    """Приём апдейтов по HTTP вместо long polling.
+
+    HTTP-потоки только проверяют секрет и кладут апдейт (JSON-объект) в очередь; диспетчер
+    собирает пачки (до WEBHOOK_BATCH_SIZE или за WEBHOOK_BATCH_MS) и отдаёт их
+    в bot.process_new_updates — дальше апдейты расходятся по шардам диспетчера.
+    """
+
+    def __init__(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT, secret=WEBHOOK_SECRET, path=WEBHOOK_PATH,
+                 batch_size=WEBHOOK_BATCH_SIZE, batch_ms=WEBHOOK_BATCH_MS, max_body=WEBHOOK_MAX_BODY):
+        if not secret:
+            raise ValueError("webhook без секрета принимал бы апдейты от кого угодно")
+        self.secret = secret
+        self.max_body = max_body
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_wait = batch_ms / 1000
+        self.updates = queue.Queue()
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self.send_error(404); return
+                token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+                if not hmac.compare_digest(token, server.secret):
+                    self.send_error(403); return
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    self.send_error(400); return
+                if length < 0 or length > server.max_body:
+                    self.send_error(413); return
+                try:
+                    update = json.loads(self.rfile.read(length))
+                except ValueError:
+                    self.send_error(400); return
+                if not isinstance(update, dict):
+                    self.send_error(400); return
+                server.updates.put(update)
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                if self.path != "/stats":
+                    self.send_error(404); return
+                body = json.dumps(bot.dispatcher.stats()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _next_batch(self):
+        batch = [self.updates.get()]
+        deadline = datetime.now() + timedelta(seconds=self.batch_wait)
+        while len(batch) < self.batch_size:
+            left = (deadline - datetime.now()).total_seconds()
+            if left <= 0:
+                break
+            try:
+                batch.append(self.updates.get(timeout=left))
+            except queue.Empty:
+                break
+        return batch
+
+    def _dispatch_loop(self):
+        while True:
+            updates = []
+            for raw in self._next_batch():
+                # кривой апдейт не должен уносить с собой всю пачку
+                try:
+                    updates.append(types.Update.de_json(raw))
+                except Exception as e:
+                    print(f"[webhook] bad update skipped: {e!r}")
+            if not updates:
+                continue
+            try:
+                bot.process_new_updates(updates)
+            except Exception as e:
+                print(f"[webhook] dispatch failed: {e!r}")
+
+    def serve_forever(self):
+        threading.Thread(target=self._dispatch_loop, name="webhook-dispatch", daemon=True).start()
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+
+def run_webhook():
+    if not WEBHOOK_SECRET:
+        print("❌ Установи WEBHOOK_SECRET: без него webhook принимает апдейты от кого угодно.")
+        sys.exit(1)
+    server = WebhookServer()
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                        allowed_updates=ALLOWED_UPDATES)
+    print(f"Webhook слушает http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    server.serve_forever()
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Karma Tracker Bot")
+    parser.add_argument("--mode", choices=["polling", "async", "webhook"], default=BOT_MODE,
+                        help="polling — блокирующий TeleBot (по умолчанию), async — AsyncTeleBot, "
+                             "webhook — встроенный HTTP-сервер")
+    parser.add_argument("--rebuild-karma", action="store_true",
+                        help="пересчитать карму и уровни из журнала karma_events и выйти")
+    args = parser.parse_args()
+
+    init_db()
+    if args.rebuild_karma:
+        print(f"Пересчитано пользователей: {rebuild_karma_totals()}")
+        sys.exit(0)
+
     if not BOT_TOKEN or BOT_TOKEN.startswith("PASTE_"):
         print("❌ Установи переменную окружения BOT_TOKEN перед запуском.")
         sys.exit(1)
@@ -954,15 +3175,24 @@ if __name__ == '__main__':
     if not PAYMENTS_AVAILABLE:
         print("⚠️ PROVIDER_TOKEN не задан — платёжные функции будут отключены.")
 
-    print("Бот запущен...")
+    start_background_workers()
+    start_metrics_server()
+    start_profiler()
+    print(f"Бот запущен ({args.mode})...")
     try:
-        # важно: явно подписываемся и на message, и на callback_query
-        bot.polling(
-            none_stop=True,
-            interval=0,
-            timeout=60,
-            allowed_updates=['message', 'callback_query']
-        )
+        if args.mode == "async":
+            asyncio.run(run_async())
+        elif args.mode == "webhook":
+            start_update_dispatcher()
+            run_webhook()
+        else:
+            start_update_dispatcher()
+            # важно: явно подписываемся и на message, и на callback_query
+            bot.polling(
+                none_stop=True,
+                interval=0,
+                timeout=60,
+                allowed_updates=ALLOWED_UPDATES
+            )
     except KeyboardInterrupt:
         print("Выключение бота...")
-
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Поддельный Telegram для локальной проверки webhook-режима.
+
+Делает две вещи:
+- поднимает фейковый Bot API (отвечает на sendMessage/getMe/... и считает вызовы);
+- шлёт на webhook бота заготовленные апдейты с секретным заголовком.
+
+Запуск:
+  TELEGRAM_API_URL="http://127.0.0.1:8081/bot{0}/{1}" WEBHOOK_SECRET=dev \\
+      python bot.py --mode webhook
+  python fake_telegram.py --secret dev --users 50
+"""
+
+import argparse
+import itertools
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+api_calls = Counter()
+_ids = itertools.count(1)
+
+MENU = ['🎯 Мои привычки', '📊 Статистика', '🏅 Лидеры', '🎁 Ежедневная награда', '🧩 Мои челленджи']
+CALLBACKS = ['chl:public', 'habit:track']
+
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    """Отвечает как api.telegram.org: {"ok": true, "result": ...}."""
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        method = url.path.rsplit("/", 1)[-1]
+        api_calls[method] += 1
+        # telebot шлёт параметры и в query string, и в теле формы
+        length = int(self.headers.get("Content-Length") or 0)
+        query = url.query + "&" + self.rfile.read(length).decode()
+        params = {k: v[0] for k, v in parse_qs(query).items()}
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "KarmaBot", "username": "karma_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = {"message_id": next(_ids), "date": int(time.time()),
+                      "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                      "text": params.get("text", "")}
+        else:
+            result = True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"user{uid}", "username": f"user{uid}"}
+
+
+def message_update(uid, text):
+    msg = {"message_id": next(_ids), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+           "from": _user(uid), "text": text}
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_ids), "message": msg}
+
+
+def callback_update(uid, data):
+    return {"update_id": next(_ids), "callback_query": {
+        "id": str(next(_ids)), "chat_instance": str(uid), "data": data, "from": _user(uid),
+        "message": {"message_id": next(_ids), "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"}, "text": "menu"}}}
+
+
+def canned_updates(users):
+    for uid in range(1, users + 1):
+        yield message_update(uid, "/start")
+    for uid in range(1, users + 1):
+        for text in MENU:
+            yield message_update(uid, text)
+        for data in CALLBACKS:
+            yield callback_update(uid, data)
+
+
+def post(url, secret, update):
+    req = urllib.request.Request(url, data=json.dumps(update).encode(), method="POST",
+                                 headers={"Content-Type": "application/json",
+                                          "X-Telegram-Bot-Api-Secret-Token": secret})
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--webhook", default="http://127.0.0.1:8443/webhook")
+    parser.add_argument("--secret", required=True, help="тот же WEBHOOK_SECRET, что у бота")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--wait", type=float, default=3.0, help="сколько ждать ответов бота, сек")
+    args = parser.parse_args()
+
+    api = ThreadingHTTPServer(("127.0.0.1", args.api_port), FakeBotApi)
+    api.daemon_threads = True
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+
+    statuses = Counter()
+    started = time.perf_counter()
+    for update in canned_updates(args.users):
+        statuses[post(args.webhook, args.secret, update)] += 1
+    posted = time.perf_counter() - started
+    time.sleep(args.wait)
+
+    total = sum(statuses.values())
+    print(f"Отправлено апдейтов: {total} за {posted:.2f} с ({total / posted:.0f}/с)")
+    print(f"HTTP-статусы webhook: {dict(statuses)}")
+    print(f"Вызовы Bot API от бота: {dict(api_calls)}")
+    api.shutdown()
+
+
+if __name__ == "__main__":
+    main()
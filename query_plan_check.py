@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка планов запросов bot.py.
+
+Находит в исходнике все SQL-строки (SELECT/INSERT/UPDATE/DELETE), прогоняет
+каждую через EXPLAIN QUERY PLAN на временной базе с накатанными миграциями и
+тестовыми данными и падает (код 1), если какой-то запрос читает таблицу
+полным перебором (SCAN <таблица> без индекса). Так новый запрос не сможет
+незаметно сделать горячий путь медленнее.
+
+Запуск:
+  python query_plan_check.py          # краткий отчёт
+  python query_plan_check.py -v       # планы всех запросов
+"""
+
+import argparse
+import ast
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import bot
+
+# после ключевого слова — пробел: имена вроде f"update-{...}.prof" за SQL не считаются
+SQL_START = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\s", re.IGNORECASE)
+FULL_SCAN = re.compile(r"^SCAN (\w+)(?: AS \w+)?$")
+
+# функции, которым полный перебор разрешён: редкие офлайн/стартовые операции
+ALLOWED_SCANS = {
+    "rebuild_karma_totals": "офлайн-пересчёт всей кармы (--rebuild-karma)",
+    "Leaderboard.load": "однократная загрузка рейтинга в память при старте",
+}
+# миграции выполняются один раз и по определению обходят таблицы целиком
+SKIP_FUNCTIONS = re.compile(r"^_m\d+_")
+
+
+def collect_queries(path):
+    """[(функция, lineno, sql)] для всех SQL-литералов; f-строки вычисляются в пространстве bot."""
+    tree = ast.parse(open(path, encoding="utf-8").read(), path)
+    queries, skipped = [], []
+
+    def visit(node, scope):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            scope = f"{scope}.{node.name}" if scope else node.name
+            if SKIP_FUNCTIONS.match(node.name):
+                return
+        if isinstance(node, ast.JoinedStr):
+            try:
+                sql = eval(compile(ast.Expression(node), path, "eval"), vars(bot))
+            except Exception:
+                # плейсхолдеры собираются в рантайме (IN (?, ?, ...)) — проверяются вручную
+                head = node.values[0].value if isinstance(node.values[0], ast.Constant) else ""
+                if SQL_START.match(head):
+                    skipped.append((scope or "<module>", node.lineno))
+                return
+            if SQL_START.match(sql):
+                queries.append((scope or "<module>", node.lineno, sql))
+            return
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            if SQL_START.match(node.value):
+                queries.append((scope or "<module>", node.lineno, node.value))
+            return
+        for child in ast.iter_child_nodes(node):
+            visit(child, scope)
+
+    visit(tree, "")
+    return queries, skipped
+
+
+def seed(users=2000, challenges=300):
+    """Немного данных, похожих на прод: пользователи, привычки, челленджи с участниками.
+
+    ANALYZE не запускаем — бот его тоже не делает, планы должны быть хорошими и без статистики.
+    """
+    now = datetime.now()
+    with bot.transaction() as c:
+        c.executemany("INSERT INTO users (user_id, username, karma, level, created_date, premium_until, is_premium) "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      [(uid, f"user{uid}", uid % 100, 1 + uid % 7, now.isoformat(),
+                        (now + timedelta(days=uid % 30)).isoformat() if uid % 10 == 0 else None,
+                        1 if uid % 10 == 0 else 0) for uid in range(1, users + 1)])
+        c.executemany("INSERT INTO habits (user_id, name, target, current_progress, created_date, is_done) "
+                      "VALUES (?, ?, 10, ?, ?, ?)",
+                      [(i % users + 1, f"habit{i}", i % 10, now.isoformat(), i % 3 == 0) for i in range(users * 2)])
+        c.executemany("INSERT INTO achievements (user_id, title, description, earned_date) VALUES (?, ?, '', ?)",
+                      [(uid, "🏆", now.isoformat()) for uid in range(1, users + 1, 3)])
+        c.executemany("INSERT INTO challenges (name, description, creator_id, prize_pool, is_public, created_at, "
+                      "status, target_count, deadline) VALUES (?, '', ?, 100, ?, ?, ?, 7, ?)",
+                      [(f"c{i}", i % users + 1, i % 4 != 0, now.isoformat(), "finished" if i % 5 == 0 else "active",
+                        (now + timedelta(days=i % 14)).isoformat()) for i in range(challenges)])
+        c.executemany("INSERT OR IGNORE INTO challenge_participants (challenge_id, user_id, progress, joined_at) "
+                      "VALUES (?, ?, ?, ?)",
+                      [(i % challenges + 1, i % users + 1, i % 8, now.isoformat()) for i in range(users * 3)])
+        c.executemany("INSERT INTO karma_events (user_id, amount, credited, reason, created_at) "
+                      "VALUES (?, 10, 10, 'daily', ?)", [(uid, now.isoformat()) for uid in range(1, users + 1)])
+
+
+def explain(sql):
+    """Строки EXPLAIN QUERY PLAN; параметры подставляются как NULL.
+
+    Шаблоны keyset_page ({cond}/{order}) проверяются с пустым условием страницы.
+    """
+    if "{cond}" in sql:
+        sql = sql.format(cond="1", order="DESC")
+    names = re.findall(r"(?<!:):(\w+)", sql)
+    params = {n: None for n in names} if names else [None] * sql.count("?")
+    return [row[3] for row in bot.db().execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-v", "--verbose", action="store_true", help="печатать планы всех запросов")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="qplan-")
+    bot.DB_PATH = os.path.join(tmp, "qplan.db")
+    bot.init_db()
+    seed()
+
+    queries, skipped = collect_queries(bot.__file__)
+    failures = 0
+    for scope, lineno, sql in queries:
+        plan = explain(sql)
+        scans = [m.group(1) for m in map(FULL_SCAN.match, plan) if m]
+        allowed = ALLOWED_SCANS.get(scope)
+        bad = scans and not allowed
+        failures += bool(bad)
+        if bad or args.verbose:
+            mark = "FAIL" if bad else ("ok*" if scans else "ok")
+            print(f"[{mark}] bot.py:{lineno} {scope}")
+            print("       " + " ".join(sql.split()))
+            for line in plan:
+                print(f"         {line}")
+    for scope, lineno in skipped:
+        print(f"[skip] bot.py:{lineno} {scope}: SQL собирается в рантайме")
+
+    print(f"Проверено запросов: {len(queries)}, с полным перебором: {failures}, "
+          f"разрешено: {', '.join(ALLOWED_SCANS)}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Отчёт по журналам профилировщика медленного (PROFILE_DIR бота).
+
+Читает slow_updates.jsonl и slow_sql.jsonl и печатает главных виновников:
+- хэндлеры с наибольшим суммарным временем медленных апдейтов;
+- самые «горячие» функции по снятым стекам (или по cProfile);
+- SQL-запросы с наибольшим суммарным временем, с формой параметров и планом.
+
+Запуск:
+  PROFILE_DIR=/tmp/trackbot-prof python bot.py
+  python slow_report.py /tmp/trackbot-prof --top 10
+"""
+
+import argparse
+import json
+import os
+import sys
+from collections import Counter, defaultdict
+
+
+def read_jsonl(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report_updates(records, top):
+    print(f"=== Медленные апдейты: {len(records)} ===")
+    if not records:
+        return
+    by_handler = defaultdict(list)
+    for r in records:
+        by_handler[r["handler"]].append(r)
+    print(f"{'хэндлер':<28}{'кол-во':>8}{'сумма мс':>12}{'p50 мс':>10}{'макс мс':>10}{'SQL ср.':>9}")
+    ranked = sorted(by_handler.items(), key=lambda kv: -sum(r["elapsed_ms"] for r in kv[1]))
+    for handler, rs in ranked[:top]:
+        times = [r["elapsed_ms"] for r in rs]
+        print(f"{handler:<28}{len(rs):>8}{sum(times):>12.0f}{percentile(times, 50):>10.0f}{max(times):>10.0f}"
+              f"{sum(r['sql'] for r in rs) / len(rs):>9.1f}")
+        worst = max(rs, key=lambda r: r["elapsed_ms"])
+        print(f"    худший: {worst['elapsed_ms']} мс, data={worst.get('data')!r}, user={worst.get('user_id')}, "
+              f"{worst['ts']}" + (f", {worst['prof']}" if worst.get("prof") else ""))
+
+    # стеки: «self» — верхний кадр, «total» — кадр встречается где-то в стеке;
+    # в режиме cprofile часть апдейтов снята сэмплами — единицы разные, печатаем отдельно
+    own, total = Counter(), Counter()
+    own_ms, total_ms = Counter(), Counter()
+    for r in records:
+        for stack, n in (r.get("stacks") or {}).items():
+            frames = stack.split(";")
+            own[frames[-1]] += n
+            for frame in set(frames):
+                total[frame] += n
+        for name, _ncalls, tottime, cumtime in r.get("top") or []:
+            own_ms[name] += tottime
+            total_ms[name] += cumtime
+    for unit, own_c, total_c in (("сэмплов", own, total), ("мс, cProfile", own_ms, total_ms)):
+        if not own_c:
+            continue
+        print(f"\nГорячие места (собственное время, {unit}):")
+        for frame, n in own_c.most_common(top):
+            print(f"  {n:>10.0f}  {frame}")
+        print(f"\nГорячие места (с вложенными вызовами, {unit}):")
+        for frame, n in total_c.most_common(top):
+            print(f"  {n:>10.0f}  {frame}")
+
+
+def report_sql(records, top):
+    print(f"\n=== Медленные SQL: {len(records)} ===")
+    if not records:
+        return
+    by_sql = defaultdict(list)
+    for r in records:
+        by_sql[r["sql"]].append(r)
+    ranked = sorted(by_sql.items(), key=lambda kv: -sum(r["elapsed_ms"] for r in kv[1]))
+    for sql, rs in ranked[:top]:
+        times = [r["elapsed_ms"] for r in rs]
+        handlers = Counter(r["handler"] or "—" for r in rs)
+        print(f"\n{len(rs)} раз, сумма {sum(times):.0f} мс, макс {max(times):.0f} мс; "
+              f"хэндлеры: {', '.join(f'{h}×{n}' for h, n in handlers.most_common(3))}")
+        print(f"  {sql}")
+        print(f"  параметры: {rs[-1]['params']}")
+        for line in rs[-1].get("plan") or []:
+            print(f"    {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", nargs="?", default=os.getenv("PROFILE_DIR", ""),
+                        help="каталог с журналами (по умолчанию PROFILE_DIR)")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+    if not args.directory or not os.path.isdir(args.directory):
+        parser.error("укажи каталог с журналами профилировщика")
+
+    report_updates(read_jsonl(os.path.join(args.directory, "slow_updates.jsonl")), args.top)
+    report_sql(read_jsonl(os.path.join(args.directory, "slow_sql.jsonl")), args.top)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())